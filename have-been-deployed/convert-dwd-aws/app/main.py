@@ -1,5 +1,9 @@
 import asyncio
-import urllib.request
+import urllib.parse
+import http.client
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import zipfile
 import io
 import csv
@@ -12,8 +16,10 @@ import traceback
 import boto3
 import uuid
 import os
-import pickle
+import marshal
+import gzip
 import hashlib
+from collections import OrderedDict, deque
 
 s3_client_eu = boto3.client("s3", region_name="eu-central-1")
 s3_client_jp = boto3.client("s3", region_name="ap-northeast-1")
@@ -23,13 +29,44 @@ tagid = os.getenv("tagid")
 base_url = os.getenv("URL")
 
 USE_SMART_CACHE = True 
-CACHE_EXPIRY = 7200  
 
-memory_cache = {}
 url_timestamps = {}  
 
+# opendata.dwd.de へのホストごとの最大同時接続数（keep-alive で再利用する）
+MAX_CONNECTIONS_PER_HOST = int(os.getenv("MaxConnectionsPerHost", "32"))
+HTTP_TIMEOUT = 30
+
 TMP_CACHE_DIR = "/tmp/dwdcache"
 MAX_TMP_STORAGE = 2000 * 1024 * 1024  
+CACHE_INDEX_PATH = f"{TMP_CACHE_DIR}/index.json"
+
+# Lambda のタイムアウト前に変換・保存を終えるために確保しておく時間（秒）
+DEADLINE_RESERVE_SECONDS = 90
+
+# 生データのマルチパートアップロードのパートサイズ（S3 の最小パートサイズは 5MB）
+RAW_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+
+# ZIP解凍・CSV解析を行うワーカープロセス数（0 の場合は vCPU 数に合わせる）
+DECODE_WORKERS = int(os.getenv("DecodeWorkers", "0")) or os.cpu_count() or 1
+# ダウンロード済みで解析待ちのZIPの最大数
+DECODE_QUEUE_SIZE = 64
+
+# 観測所ファイルは末尾のこのサイズだけを行として解析する
+TAIL_READ_SIZE = 64 * 1024
+
+# Apache のディレクトリリスティングから ZIP ごとのファイル名・更新時刻・サイズを抽出
+LISTING_ENTRY_PATTERN = re.compile(
+    r'href="(10minutenwerte_\w+_\d+_now\.zip)">[^<]*</a>\s+(\d{2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2})\s+(\d+)'
+)
+
+CATEGORIES = [
+    "air_temperature",
+    "extreme_temperature",
+    "extreme_wind",
+    "precipitation",
+    "solar",
+    "wind"
+]
 
 MISSING_VALUES = {
     "INT8": -99,
@@ -45,154 +82,195 @@ INVALID_VALUES = {
     "STR": ""
 }
 
+# 変換先要素ごとの (倍率, 四捨五入するか)。四捨五入しない要素は切り捨てで整数化する
+ELEMENT_SCALES = {
+    'ARPRSS': (10, True),
+    'AIRTMP': (10, False),
+    'RHUM': (10, True),
+    'DEWTMP': (10, False),
+    'AIRTMP_10MIN_MAX': (10, False),
+    'AIRTMP_10MIN_MINI': (10, False),
+    'WNDSPD': (10, True),
+    'WNDDIR': (1, True),
+    'GUSTS': (10, True),
+    'WNDSPD_10MIN_MAX': (10, True),
+    'GUSTD': (10, True),
+    'PRCRIN_10MIN': (10, True),
+    'SCTRAD_10MIN': (10000, True),
+    'GLBRAD_10MIN': (10000, True),
+    'SUNDUR_10MIN': (60, True),
+}
+
+# 無効値として扱うDWDの生データ
+INVALID_RAW_VALUES = frozenset(['---', '', '-9999', '-999'])
+
 def get_missing_value(value_type):
     return MISSING_VALUES.get(value_type, None)
 
 def get_invalid_value(value_type):
     return INVALID_VALUES.get(value_type, None)
 
-def get_memory_cache(key):  
-    if not USE_SMART_CACHE:
-        return None
+class FileCacheStore:
+    """/tmp cache with a single in-memory index and LRU eviction.
+
+    The index maps each key to [size, mtime, update_time, validators] in LRU
+    order and is persisted atomically, so no directory walks or sidecar files
+    are needed. validators holds the ETag and Last-Modified of HTTP responses.
+    Payloads are stored with marshal.
+    """
+
+    def __init__(self, directory=TMP_CACHE_DIR, max_size=MAX_TMP_STORAGE, index_path=CACHE_INDEX_PATH):
+        self.directory = directory
+        self.max_size = max_size
+        self.index_path = index_path
+        self.index = OrderedDict()
+        self.total_size = 0
+        self.loaded = False
+        self.dirty = False
+
+    def _path(self, key):
+        return f"{self.directory}/{hashlib.md5(key.encode('utf-8')).hexdigest()}.bin"
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with open(self.index_path, 'r') as f:
+                self.index = OrderedDict(
+                    (key, (list(entry) + [None] * 4)[:4]) for key, entry in json.load(f).items()
+                )
+            self.total_size = sum(entry[0] for entry in self.index.values())
+            print(f"Loaded cache index with {len(self.index)} entries ({self.total_size/1024/1024:.2f}MB)")
+        except FileNotFoundError:
+            self._clear_payloads()
+        except Exception as e:
+            print(f"Error loading cache index, clearing cache: {e}")
+            self._clear_payloads()
+
+    def _clear_payloads(self):
+        # インデックスがない場合、追跡できないペイロードは削除して容量を正しく数える
+        self.index = OrderedDict()
+        self.total_size = 0
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.bin'):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+
+    def get(self, key, cache_expiry, min_update_time=None):
+        entry = self.index.get(key)
+        if entry is None:
+            return None
         
-    try:
-        if key in memory_cache:
-            cache_data = memory_cache[key]
-            if datetime.now(timezone.utc).timestamp() - cache_data['timestamp'] < CACHE_EXPIRY:
-                return cache_data['data']
-            del memory_cache[key]
-    except Exception as e:
-        print(f"Memory cache access error: {e}")
-    return None
+        _, mtime, update_time, validators = entry
+        outdated = min_update_time is not None and (update_time or 0) < min_update_time
+        if outdated or time.time() - mtime >= cache_expiry:
+            # 検証子があるエントリは条件付きリクエストで再検証できるため残しておく
+            if not validators:
+                self.delete(key)
+            return None
+        
+        return self.read(key)
 
-def set_memory_cache(key, data):
-    if not USE_SMART_CACHE:
-        return False
+    def read(self, key):
+        """Return the payload of key regardless of its age."""
+        if key not in self.index:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            print(f"File cache read error for {key}: {e}")
+            self.delete(key)
+            return None
         
-    try:
-        memory_cache[key] = {
-            'timestamp': datetime.now(timezone.utc).timestamp(),
-            'data': data
-        }
-        return True
-    except Exception as e:
-        print(f"Memory cache save error: {e}")
-        return False
+        self.index.move_to_end(key)
+        self.dirty = True
+        return data
 
-def cleanup_memory_cache():
-    if not USE_SMART_CACHE:
-        memory_cache.clear()
-        return
+    def get_validators(self, key):
+        entry = self.index.get(key)
+        return entry[3] if entry else None
+
+    def touch(self, key, update_time=None):
+        """Mark a revalidated entry as fresh without rewriting its payload."""
+        entry = self.index.get(key)
+        if entry:
+            entry[1] = time.time()
+            entry[2] = update_time
+            self.dirty = True
+
+    def set(self, key, data, update_time=None, validators=None):
+        payload = marshal.dumps(data)
+        self.delete(key)
         
-    current_time = datetime.now(timezone.utc).timestamp()
-    expired_keys = [
-        key for key, cache_data in memory_cache.items()
-        if current_time - cache_data['timestamp'] > CACHE_EXPIRY
-    ]
-    for key in expired_keys:
-        del memory_cache[key]
+        while self.index and self.total_size + len(payload) > self.max_size:
+            oldest_key = next(iter(self.index))
+            print(f"Evicting cache entry: {oldest_key}, size: {self.index[oldest_key][0]/1024:.2f}KB")
+            self.delete(oldest_key)
+        
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+        
+        self.index[key] = [len(payload), time.time(), update_time, validators]
+        self.total_size += len(payload)
+        self.dirty = True
+
+    def delete(self, key):
+        entry = self.index.pop(key, None)
+        if entry is None:
+            return
+        self.total_size -= entry[0]
+        self.dirty = True
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def save(self):
+        if not self.dirty:
+            return True
+        try:
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp_path, self.index_path)
+            self.dirty = False
+            return True
+        except Exception as e:
+            print(f"Error saving cache index: {e}")
+            return False
+
+file_cache = FileCacheStore()
 
 def init_file_cache():
     try:
         if not os.path.exists(TMP_CACHE_DIR):
             os.makedirs(TMP_CACHE_DIR)
+        file_cache.load()
         return True
     except Exception as e:
         print(f"Error initializing cache directory: {e}")
         return False
 
-def get_file_cache_key(url):
-    return hashlib.md5(url.encode('utf-8')).hexdigest()
-
-def check_tmp_storage():
-    if not os.path.exists(TMP_CACHE_DIR):
-        return 0
-        
-    total_size = 0
-    for dirpath, _, filenames in os.walk(TMP_CACHE_DIR):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            if os.path.exists(fp):
-                total_size += os.path.getsize(fp)
-    return total_size
-
-def cleanup_old_cache(required_space=50*1024*1024):
-    if not os.path.exists(TMP_CACHE_DIR):
-        return True
-        
-    cache_files = []
-    try:
-        for filename in os.listdir(TMP_CACHE_DIR):
-            if filename.endswith('.data'):  
-                filepath = os.path.join(TMP_CACHE_DIR, filename)
-                if os.path.exists(filepath):
-                    cache_files.append((filepath, os.path.getmtime(filepath)))
-    
-        cache_files.sort(key=lambda x: x[1])
-        
-        freed_space = 0
-        for filepath, _ in cache_files:
-            if freed_space >= required_space or len(cache_files) <= 5:  # 最低5つはキャッシュを残す
-                break
-                
-            if os.path.exists(filepath):
-                file_size = os.path.getsize(filepath)
-                try:
-                    os.remove(filepath)
-                    meta_path = filepath.replace('.data', '.meta')
-                    if os.path.exists(meta_path):
-                        os.remove(meta_path)
-                    freed_space += file_size
-                    print(f"Removed old cache file: {filepath}, size: {file_size/1024:.2f}KB")
-                except Exception as e:
-                    print(f"Error removing cache file {filepath}: {e}")
-                    
-        return True
-    except Exception as e:
-        print(f"Error cleaning up cache: {e}")
-        return False
-
 def get_file_cache(url, cache_expiry=3600):
     if not USE_SMART_CACHE:
         return None
         
     try:
-        cache_key = get_file_cache_key(url)
-        cache_path = f"{TMP_CACHE_DIR}/cache_{cache_key}.data"
-        meta_path = f"{TMP_CACHE_DIR}/cache_{cache_key}.meta"
-        
-        if os.path.exists(cache_path) and os.path.exists(meta_path):
-            with open(meta_path, 'r') as f:
-                metadata = json.load(f)
-                
-            # 更新時刻が記録されている場合、比較して使用するかどうか判断
-            if url in url_timestamps:
-                cached_update_time = metadata.get('update_time', 0)
-                if cached_update_time < url_timestamps[url]:
-                    print(f"Cache for {url} is outdated, will fetch new data")
-                    try:
-                        os.remove(meta_path)
-                        os.remove(cache_path)
-                    except:
-                        pass
-                    return None
-            
-            if time.time() - metadata['timestamp'] < cache_expiry:
-                with open(cache_path, 'rb') as f:
-                    return pickle.load(f)
-            
-            try:
-                os.remove(meta_path)
-                os.remove(cache_path)
-            except:
-                pass  
-                
+        # 更新時刻が記録されている場合、それより古いキャッシュは使用しない
+        return file_cache.get(url, cache_expiry, url_timestamps.get(url))
     except Exception as e:
         print(f"File cache read error for {url}: {e}")
     
     return None
 
-def set_file_cache(url, data, update_time=None):
+def set_file_cache(url, data, update_time=None, validators=None):
     if not USE_SMART_CACHE:
         return False
         
@@ -200,33 +278,7 @@ def set_file_cache(url, data, update_time=None):
         return False
         
     try:
-        estimated_size = len(pickle.dumps(data))
-        
-        current_usage = check_tmp_storage()
-        
-        if current_usage + estimated_size > MAX_TMP_STORAGE:
-            cleanup_old_cache(estimated_size)
-        
-        cache_key = get_file_cache_key(url)
-        cache_path = f"{TMP_CACHE_DIR}/cache_{cache_key}.data"
-        meta_path = f"{TMP_CACHE_DIR}/cache_{cache_key}.meta"
-        
-        with open(cache_path, 'wb') as f:
-            pickle.dump(data, f)
-        
-        metadata = {
-            'timestamp': time.time(),
-            'url': url,
-            'size': os.path.getsize(cache_path)
-        }
-        
-        # 更新時刻情報がある場合は保存
-        if update_time is not None:
-            metadata['update_time'] = update_time
-        
-        with open(meta_path, 'w') as f:
-            json.dump(metadata, f)
-        
+        file_cache.set(url, data, update_time, validators)
         return True
     except Exception as e:
         print(f"File cache write error for {url}: {e}")
@@ -243,61 +295,307 @@ def validate_env_vars():
     if missing_vars:
         raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
 
-def fetch_first_file_modified(url):
+def parse_directory_listing(content):
+    """Return {filename: (mtime, size)} for every station ZIP in a DWD listing page."""
+    entries = {}
+    for filename, date_str, size in LISTING_ENTRY_PATTERN.findall(content):
+        try:
+            mtime = datetime.strptime(date_str, '%d-%b-%Y %H:%M').replace(tzinfo=timezone.utc).timestamp()
+        except ValueError as e:
+            print(f"Error parsing listing entry {filename}: {e}")
+            continue
+        entries[filename] = (mtime, int(size))
+    return entries
 
-    try:
-        cache_key = f"url_modified_{url}"
-        
-        ctx = ssl.create_default_context()
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
-        
-        with urllib.request.urlopen(url, context=ctx) as response:
-            content = response.read().decode('utf-8')
-            lines = [line.strip() for line in content.split('\n') if line.strip()]
-            
-            for i, line in enumerate(lines):
-                if '10minutenwerte_TU_' in line and '_now.zip' in line:
-                    date_parts = line.split()
-                    for j in range(len(date_parts)):
-                        if re.match(r'\d{2}-[A-Za-z]{3}-\d{4}', date_parts[j]):
-                            try:
-                                date_str = f"{date_parts[j]} {date_parts[j+1]}"
-                                print(f"Found date string: {date_str}")
-                                
-                                timestamp = datetime.strptime(
-                                    date_str, 
-                                    '%d-%b-%Y %H:%M'
-                                ).replace(tzinfo=timezone.utc)
-                                
-                                file_size = int(date_parts[j+2])
-                                print(f"Successfully parsed - Date: {timestamp}, Size: {file_size}")
-                                
-                                update_timestamp = timestamp.timestamp()
-                                url_timestamps[url] = update_timestamp
-                                
-                                category = url.split('/')[-3] 
-                                category_url = f"{base_url}{category}/now/"
-                                url_timestamps[category_url] = update_timestamp
-                                
-                                result = (timestamp, file_size)
-                                
-                                if USE_SMART_CACHE:
-                                    set_memory_cache(cache_key, result)
-                                    set_file_cache(cache_key, result, update_timestamp)
-                                
-                                return result
-                            except (ValueError, IndexError) as e:
-                                print(f"Error parsing date parts: {e}")
-                                continue
-
-            print("No valid file entries were found after processing all lines.")
-            return None, None
+def is_valid_timestamp(value):
+    return len(value) == 12 and value.isdigit()
 
-    except Exception as e:
-        print(f"Error fetching first file modified date for {url}: {e}")
-        traceback.print_exc()
-        return None, None
+def read_header_and_latest_row(stream):
+    """Stream a produkt_*.txt member and return (headers, latest_row) from its first line and tail.
+
+    MESS_DATUM is fixed-width YYYYMMDDHHMM, so rows are compared as strings.
+    """
+    headers = next(csv.reader([stream.readline().decode('utf-8')], delimiter=';'), None)
+    
+    tail = b""
+    truncated = False
+    while True:
+        chunk = stream.read(TAIL_READ_SIZE)
+        if not chunk:
+            break
+        tail += chunk
+        if len(tail) > TAIL_READ_SIZE:
+            tail = tail[-TAIL_READ_SIZE:]
+            truncated = True
+    
+    lines = tail.decode('utf-8', errors='replace').splitlines()
+    if truncated:
+        # 切り詰めで途中から始まる先頭行は捨てる
+        lines = lines[1:]
+    
+    latest_row = None
+    for row in csv.reader(lines, delimiter=';'):
+        if len(row) > 1 and is_valid_timestamp(row[1]):
+            if latest_row is None or row[1] > latest_row[1]:
+                latest_row = row
+    return headers, latest_row
+
+def parse_station_zip(content):
+    """Return (headers, latest_row) of the produkt_*.txt file in a station ZIP."""
+    with zipfile.ZipFile(io.BytesIO(content)) as z:
+        txt_file = [f for f in z.namelist() if f.endswith('.txt')][0]
+        with z.open(txt_file) as f:
+            return read_header_and_latest_row(f)
+
+def decode_station_zip(station_id, category, content):
+    headers, latest_row = parse_station_zip(content)
+    return station_id, category, headers, latest_row
+
+def _decode_worker_loop(conn):
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        try:
+            conn.send((True, decode_station_zip(*job)))
+        except Exception as e:
+            conn.send((False, str(e)))
+    conn.close()
+
+class DecodeProcessPool:
+    """Worker processes connected by multiprocessing.Pipe.
+
+    Lambda has no /dev/shm, so ProcessPoolExecutor and multiprocessing.Queue
+    cannot be used there; each worker is driven over its own pipe instead.
+    """
+
+    def __init__(self, workers):
+        self.processes = []
+        self.connections = []
+        for _ in range(workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_decode_worker_loop, args=(child_conn,), daemon=True)
+            process.start()
+            child_conn.close()
+            self.processes.append(process)
+            self.connections.append(parent_conn)
+
+    def __len__(self):
+        return len(self.processes)
+
+    def run(self, index, *job):
+        conn = self.connections[index]
+        conn.send(job)
+        ok, result = conn.recv()
+        if not ok:
+            raise ValueError(result)
+        return result
+
+    def close(self):
+        for conn in self.connections:
+            try:
+                conn.send(None)
+                conn.close()
+            except Exception:
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+def find_first_file_modified(entries):
+    """Return (timestamp, size) of the first air temperature ZIP in parsed listing entries."""
+    for filename, (update_timestamp, file_size) in entries.items():
+        if filename.startswith('10minutenwerte_TU_'):
+            timestamp = datetime.fromtimestamp(update_timestamp, tz=timezone.utc)
+            print(f"Successfully parsed - Date: {timestamp}, Size: {file_size}")
+            return timestamp, file_size
+
+    print("No valid file entries were found after processing all lines.")
+    return None, None
+
+def generate_snapshot_s3_key(tagid, shard_id=None):
+    if shard_id:
+        return f"{tagid}/state/station_snapshot_{shard_id}.json.gz"
+    return f"{tagid}/state/station_snapshot.json.gz"
+
+def generate_partial_s3_prefix(tagid, run_id):
+    return f"{tagid}/partial/{run_id}/"
+
+def generate_partial_s3_key(tagid, run_id, shard_id):
+    return f"{generate_partial_s3_prefix(tagid, run_id)}{shard_id}.json.gz"
+
+def default_run_id():
+    # run_local 用。現在時刻を10分単位に切り捨てた値を run_id にする
+    now = datetime.now(timezone.utc)
+    return now.replace(minute=now.minute - now.minute % 10).strftime('%Y%m%d%H%M')
+
+def parse_shard_spec(spec):
+    """Return (shard_id, categories, station_range) from the shard spec of an event.
+
+    spec = {"id": "a", "categories": ["wind", ...], "station_range": [first_id, last_id]}
+    """
+    categories = spec.get("categories") or None
+    if categories:
+        unknown = [category for category in categories if category not in CATEGORIES]
+        if unknown:
+            raise ValueError(f"Unknown categories in shard spec: {', '.join(unknown)}")
+    
+    station_range = spec.get("station_range")
+    if station_range is not None:
+        station_range = (int(station_range[0]), int(station_range[1]))
+    
+    shard_id = spec.get("id")
+    if not shard_id:
+        raise ValueError("Shard spec requires an id")
+    return str(shard_id), categories, station_range
+
+class LocalS3Client:
+    """In-process stand-in for the boto3 S3 client, used by run_local."""
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode('utf-8')
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        return {'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)])} for key in keys], 'IsTruncated': False}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = str(uuid.uuid4())
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.uploads.pop(UploadId, None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for item in Delete['Objects']:
+            self.objects.pop((Bucket, item['Key']), None)
+        return {}
+
+class StationSnapshot:
+    """Last processed row of every station ZIP with its listing mtime and size.
+
+    Stored as one gzip JSON object in the raw data bucket so that cold starts can
+    skip unchanged files too. Header rows are shared through a lookup table.
+    """
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.files = {}
+        self.pending = set()
+
+    def load(self):
+        try:
+            response = s3_client_eu.get_object(Bucket=self.bucket, Key=self.key)
+            payload = json.loads(gzip.decompress(response['Body'].read()))
+            headers_table = payload['headers']
+            self.files = {
+                url: {
+                    'entry': (mtime, size),
+                    'station_id': station_id,
+                    'headers': headers_table[headers_index],
+                    'data': row
+                }
+                for url, (mtime, size, station_id, headers_index, row) in payload['files'].items()
+            }
+            self.pending = set(payload.get('pending', []))
+            print(f"Loaded station snapshot with {len(self.files)} files, {len(self.pending)} pending from last run")
+        except s3_client_eu.exceptions.NoSuchKey:
+            print("No station snapshot found, all files will be processed")
+            self.files = {}
+            self.pending = set()
+        except Exception as e:
+            print(f"Error loading station snapshot: {e}")
+            self.files = {}
+            self.pending = set()
+
+    def get_unchanged(self, url, entry):
+        """Return (station_id, station_data) when the file has not changed since the snapshot."""
+        snapshot = self.files.get(url)
+        if snapshot is None or snapshot['entry'] != tuple(entry):
+            return None
+        return self.get_last(url)
+
+    def get_last(self, url):
+        """Return the last processed (station_id, station_data) of the file, changed or not."""
+        snapshot = self.files.get(url)
+        if snapshot is None:
+            return None
+        return snapshot['station_id'], {'headers': snapshot['headers'], 'data': snapshot['data']}
+
+    def staleness_key(self, url_info):
+        """Sort key placing files left over from the last run first, then the oldest processed ones."""
+        url = url_info[0]
+        snapshot = self.files.get(url)
+        return (url not in self.pending, snapshot['entry'][0] if snapshot else 0)
+
+    def update(self, url, entry, station_id, station_data):
+        self.files[url] = {
+            'entry': tuple(entry),
+            'station_id': station_id,
+            'headers': station_data['headers'],
+            'data': station_data['data']
+        }
+
+    def save(self, current_urls):
+        # リスティングが取得できなかった場合は前回のスナップショットをそのまま残す
+        if not current_urls:
+            print("No files listed, keeping the previous station snapshot")
+            return
+        # リスティングから消えたファイルは除外して保存
+        self.files = {url: snapshot for url, snapshot in self.files.items() if url in current_urls}
+        headers_table = []
+        headers_indices = {}
+        files = {}
+        for url, snapshot in self.files.items():
+            headers_key = tuple(snapshot['headers'])
+            if headers_key not in headers_indices:
+                headers_indices[headers_key] = len(headers_table)
+                headers_table.append(snapshot['headers'])
+            mtime, size = snapshot['entry']
+            files[url] = [mtime, size, snapshot['station_id'], headers_indices[headers_key], snapshot['data']]
+        
+        try:
+            payload = {'headers': headers_table, 'files': files, 'pending': sorted(self.pending & set(current_urls))}
+            body = gzip.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+            s3_client_eu.put_object(
+                Body=body,
+                Bucket=self.bucket,
+                Key=self.key,
+                ContentType='application/json',
+                ContentEncoding='gzip'
+            )
+            print(f"Saved station snapshot with {len(files)} files ({len(body)/1024:.2f}KB)")
+            return True
+        except Exception as e:
+            print(f"Error saving station snapshot: {e}")
+            return False
 
 def generate_raw_s3_key(tagid, filename):
     return f"{tagid}/{datetime.now(timezone.utc).strftime('%Y/%m/%d')}/{filename}"
@@ -305,86 +603,402 @@ def generate_raw_s3_key(tagid, filename):
 def generate_json_s3_key(tagid, filename):
     return f"data/{tagid}/{datetime.now(timezone.utc).strftime('%Y/%m/%d')}/{filename}"
 
+class HTTPConnectionPool:
+    """HTTP/1.1 keep-alive connection pool with a per-host connection cap."""
+
+    def __init__(self, context, max_per_host=MAX_CONNECTIONS_PER_HOST, timeout=HTTP_TIMEOUT):
+        self.context = context
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._idle = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        self.opened += 1
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout, context=self.context)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _acquire(self, key):
+        with self._lock:
+            slot = self._slots.setdefault(key, threading.BoundedSemaphore(self.max_per_host))
+            idle = self._idle.setdefault(key, [])
+        slot.acquire()
+        with self._lock:
+            if idle:
+                self.reused += 1
+                return idle.pop()
+        return self._new_connection(key)
+
+    def _release(self, key, conn, reusable):
+        with self._lock:
+            if reusable:
+                self._idle[key].append(conn)
+            else:
+                conn.close()
+        self._slots[key].release()
+
+    def request(self, url, headers=None):
+        """GET the URL over a pooled connection and return (status, headers, body)."""
+        parsed = urllib.parse.urlsplit(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path or "/"
+        if parsed.query:
+            path = f"{path}?{parsed.query}"
+
+        conn = self._acquire(key)
+        reusable = False
+        try:
+            # アイドル中にサーバー側で切断された接続は一度だけ張り直す
+            for attempt in range(2):
+                try:
+                    conn.request("GET", path, headers=headers or {})
+                    response = conn.getresponse()
+                    body = response.read()
+                    reusable = not response.will_close
+                    return response.status, response.headers, body
+                except (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                        ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    if attempt:
+                        raise
+                    conn = self._new_connection(key)
+        finally:
+            self._release(key, conn, reusable)
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for conn in connections:
+                    conn.close()
+            self._idle.clear()
+
+class TimeBudget:
+    """Dispatch deadline taken from the Lambda context, minus a reserve for saving output."""
+
+    def __init__(self, context=None, reserve=DEADLINE_RESERVE_SECONDS):
+        self.deadline = None
+        get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+        if get_remaining_time:
+            self.deadline = time.monotonic() + get_remaining_time() / 1000 - reserve
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def exhausted(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for outgoing requests.
+
+    The limit grows by one per window of healthy responses and is halved on a
+    timeout, connection error, 5xx or a response slower than latency_target.
+    Decreases are spaced by backoff_interval so one burst of failures only
+    counts once.
+    """
+
+    def __init__(self, initial=16, minimum=2, maximum=MAX_CONNECTIONS_PER_HOST,
+                 latency_target=10.0, backoff_interval=1.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.latency_target = latency_target
+        self.backoff_interval = backoff_interval
+        self.in_flight = 0
+        self.peak_limit = self.limit
+        self.decreases = 0
+        self.latencies = []
+        self._last_decrease = 0.0
+        self._waiters = deque()
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+
+    def release(self, latency, failed):
+        self.in_flight -= 1
+        if failed or latency > self.latency_target:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.backoff_interval:
+                self.limit = max(self.minimum, self.limit / 2)
+                self._last_decrease = now
+                self.decreases += 1
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.peak_limit = max(self.peak_limit, self.limit)
+        if not failed:
+            self.latencies.append(latency)
+        self._wake()
+
+    def release_unused(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        
+        def percentile(q):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))], 3)
+        
+        return {
+            'concurrency_limit': int(self.limit),
+            'peak_concurrency_limit': int(self.peak_limit),
+            'limit_decreases': self.decreases,
+            'latency_p50': percentile(0.50),
+            'latency_p90': percentile(0.90),
+            'latency_p99': percentile(0.99),
+            'requests': len(latencies)
+        }
+
 class AsyncHTTPClient:
-    def __init__(self, max_connections=150):  
-        self.semaphore = asyncio.Semaphore(max_connections)
+    def __init__(self, max_connections=150, max_connections_per_host=MAX_CONNECTIONS_PER_HOST):  
+        # 同時リクエスト数は接続プールの上限を超えても意味がないためそこで頭打ちにする
+        self.limiter = AdaptiveLimiter(maximum=min(max_connections, max_connections_per_host))
         self.context = ssl.create_default_context()
         self.context.check_hostname = False
         self.context.verify_mode = ssl.CERT_NONE
         self.retry_count = 5  
         self.retry_delay = 3  
+        self.pool = HTTPConnectionPool(self.context, max_per_host=max_connections_per_host)
+        self.executor = ThreadPoolExecutor(max_workers=max_connections_per_host)
+        # タグ（カテゴリ）ごとの 200/304 件数と転送・節約バイト数
+        self.response_counts = {}
 
-    async def get(self, url, timeout=100):
-        if USE_SMART_CACHE:
+    def count_response(self, tag, status, size):
+        if tag is None:
+            return
+        counts = self.response_counts.setdefault(tag, {'200': 0, '304': 0, 'bytes_received': 0, 'bytes_saved': 0})
+        counts[str(status)] += 1
+        counts['bytes_received' if status == 200 else 'bytes_saved'] += size
 
-            cache_key = url
-            cached_data = get_file_cache(cache_key)
-            if cached_data:
-                return cached_data
-
-            cache_key = f"url_{url}"
-            cached_data = get_memory_cache(cache_key)
+    async def get(self, url, timeout=100, use_cache=True, deadline=None, tag=None):
+        validators = None
+        if USE_SMART_CACHE and use_cache:
+            cached_data = get_file_cache(url)
             if cached_data:
                 return cached_data
+            
+            # 古くなったキャッシュは ETag / Last-Modified で条件付きリクエストを送る
+            validators = file_cache.get_validators(url)
 
-        async with self.semaphore:
-            for attempt in range(self.retry_count):
-                try:
-                    data = await asyncio.wait_for(
-                        asyncio.to_thread(
-                            self._make_request, url
-                        ),
-                        timeout=timeout
-                    )
-                    if data:
-                        if USE_SMART_CACHE:
-                            update_time = url_timestamps.get(url)
-                            set_memory_cache(f"url_{url}", data)
-                            set_file_cache(url, data, update_time)
-                        return data
-                    
-                    if attempt < self.retry_count - 1:
-                        await asyncio.sleep(self.retry_delay * (attempt + 1))  
-                    
-                except asyncio.TimeoutError:
-                    print(f"Timeout fetching {url} (attempt {attempt+1}/{self.retry_count})")
-                    if attempt < self.retry_count - 1:
-                        await asyncio.sleep(self.retry_delay * (attempt + 1))
-                
-                except Exception as e:
-                    print(f"Error fetching {url}: {str(e)} (attempt {attempt+1}/{self.retry_count})")
-                    if attempt < self.retry_count - 1:
-                        await asyncio.sleep(self.retry_delay * (attempt + 1))
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retry_count):
+            await self.limiter.acquire()
+            attempt_timeout = timeout
+            if deadline is not None:
+                attempt_timeout = min(timeout, deadline - time.monotonic())
+                if attempt_timeout <= 0:
+                    self.limiter.release_unused()
+                    return None
+            
+            request_headers = {}
+            if validators:
+                if validators.get('etag'):
+                    request_headers['If-None-Match'] = validators['etag']
+                if validators.get('last_modified'):
+                    request_headers['If-Modified-Since'] = validators['last_modified']
+            
+            started = time.monotonic()
+            status, response_headers, data = None, None, None
+            try:
+                status, response_headers, data = await asyncio.wait_for(
+                    loop.run_in_executor(
+                        self.executor, self._make_request, url, request_headers
+                    ),
+                    timeout=attempt_timeout
+                )
+            except asyncio.TimeoutError:
+                print(f"Timeout fetching {url} (attempt {attempt+1}/{self.retry_count})")
+            except Exception as e:
+                print(f"Error fetching {url}: {str(e)} (attempt {attempt+1}/{self.retry_count})")
+            finally:
+                self.limiter.release(time.monotonic() - started, status is None or status >= 500)
+            
+            if status == 304 and validators:
+                cached_data = file_cache.read(url)
+                if cached_data:
+                    file_cache.touch(url, url_timestamps.get(url))
+                    self.count_response(tag, 304, len(cached_data))
+                    return cached_data
+                # キャッシュ本体が読めない場合は条件なしで取り直す
+                validators = None
+                continue
+            
+            if status == 200 and data:
+                self.count_response(tag, 200, len(data))
+                if USE_SMART_CACHE and use_cache:
+                    update_time = url_timestamps.get(url)
+                    new_validators = {
+                        'etag': response_headers.get('ETag'),
+                        'last_modified': response_headers.get('Last-Modified')
+                    }
+                    set_file_cache(url, data, update_time, new_validators if any(new_validators.values()) else None)
+                return data
             
-            return None  
+            # 待機中はスロットを解放しておき、他のリクエストに譲る
+            if attempt < self.retry_count - 1:
+                await asyncio.sleep(self.retry_delay * (attempt + 1))
+        
+        return None  
 
-    def _make_request(self, url):
+    def _make_request(self, url, headers=None):
         try:
-            with urllib.request.urlopen(
-                url, 
-                context=self.context, 
-                timeout=30
-            ) as response:
-                return response.read()
+            status, response_headers, body = self.pool.request(url, headers)
+            if status not in (200, 304):
+                print(f"Request error for {url}: HTTP {status}")
+            return status, response_headers, body
         except Exception as e:
             print(f"Request error for {url}: {str(e)}")
-            return None
+            return None, None, None
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.pool.close()
+        print(f"HTTP connections opened: {self.pool.opened}, reused: {self.pool.reused}")
+
+class S3StreamingWriter:
+    """Buffer text sections and upload them to S3 while the rest is still being built.
+
+    Once the buffer passes part_size, it is sent as a multipart upload part in
+    the background. Output smaller than one part is uploaded with a single
+    put_object on close.
+    """
+
+    def __init__(self, client, bucket, key, content_type, part_size=RAW_UPLOAD_PART_SIZE):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.part_size = part_size
+        self.buffer = []
+        self.buffered = 0
+        self.size = 0
+        self.part_tasks = []
+        self.upload_id_task = None
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.size += len(data)
+        if self.buffered >= self.part_size:
+            self._start_part()
+
+    def _take_buffer(self):
+        body = b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        return body
+
+    def _start_part(self):
+        if self.upload_id_task is None:
+            self.upload_id_task = asyncio.create_task(self._create_upload())
+        part_number = len(self.part_tasks) + 1
+        self.part_tasks.append(asyncio.create_task(self._upload_part(part_number, self._take_buffer())))
+
+    async def _create_upload(self):
+        response = await asyncio.to_thread(
+            self.client.create_multipart_upload,
+            Bucket=self.bucket,
+            Key=self.key,
+            ContentType=self.content_type
+        )
+        return response['UploadId']
+
+    async def _upload_part(self, part_number, body):
+        upload_id = await self.upload_id_task
+        response = await asyncio.to_thread(
+            self.client.upload_part,
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    async def close(self):
+        try:
+            if not self.part_tasks:
+                await asyncio.to_thread(
+                    self.client.put_object,
+                    Body=self._take_buffer(),
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    ContentType=self.content_type
+                )
+            else:
+                if self.buffer:
+                    self._start_part()
+                parts = await asyncio.gather(*self.part_tasks)
+                await asyncio.to_thread(
+                    self.client.complete_multipart_upload,
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=await self.upload_id_task,
+                    MultipartUpload={'Parts': parts}
+                )
+            print(f"Successfully saved raw data to EU S3: {self.bucket}/{self.key} "
+                  f"({self.size/1024:.2f}KB, {max(1, len(self.part_tasks))} part(s))")
+            return True
+        except Exception as error:
+            print(f"Failed to save raw data to EU S3: {str(error)}")
+            if self.upload_id_task is not None:
+                await asyncio.gather(*self.part_tasks, return_exceptions=True)
+                try:
+                    await asyncio.to_thread(
+                        self.client.abort_multipart_upload,
+                        Bucket=self.bucket,
+                        Key=self.key,
+                        UploadId=await self.upload_id_task
+                    )
+                except Exception as abort_error:
+                    print(f"Failed to abort multipart upload: {str(abort_error)}")
+            return False
 
 class ZipProcessor:
-    def __init__(self):
+    def __init__(self, categories=None, station_range=None, shard_id=None):
         self.http_client = AsyncHTTPClient(max_connections=200) 
         self.base_url = base_url
-        self.categories = [
-            "air_temperature",
-            "extreme_temperature",
-            "extreme_wind",
-            "precipitation",
-            "solar",
-            "wind"
-        ]
+        # シャードモードではカテゴリと観測所IDの範囲を絞り込む
+        self.categories = list(categories or CATEGORIES)
+        self.station_range = station_range
+        self.shard_id = shard_id
         self.processed_count = 0
         self.total_files = 0
         self.station_data = {}
+        self.file_entries = {}
+        self.snapshot = StationSnapshot(raw_data_bucket, generate_snapshot_s3_key(tagid, shard_id))
+        self.listing_tasks = {}
+        self.decode_queue = None
+        self.decode_pool = None
+        self.pending_urls = deque()
+        self.budget = TimeBudget()
+        self.header_layouts = {}
         
         self.element_mapping = {
             'air_temperature': {
@@ -414,20 +1028,6 @@ class ZipProcessor:
             }
         }
 
-    def save_to_s3_raw(self, body, key):
-        try:
-            s3_client_eu.put_object(
-                Body=body,
-                Bucket=raw_data_bucket,
-                Key=key,
-                ContentType='text/csv'  
-            )
-            print(f"Successfully saved raw data to EU S3: {raw_data_bucket}/{key}")
-            return True
-        except Exception as error:
-            print(f"Failed to save raw data to EU S3: {str(error)}")
-            return False
-
     def save_to_s3_converted(self, body, key):
         try:
             s3_client_jp.put_object(
@@ -442,50 +1042,50 @@ class ZipProcessor:
             print(f"Failed to save converted data to JP S3: {str(error)}")
             return False
         
-    async def check_category_update_time(self, category):
+    def get_listing(self, category):
+        """Return a shared task that fetches and parses a category listing once per run."""
+        task = self.listing_tasks.get(category)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_listing(category))
+            self.listing_tasks[category] = task
+        return task
+
+    async def _fetch_listing(self, category):
         url = f"{self.base_url}{category}/now/"
-        timestamp, _ = fetch_first_file_modified(url)
-        if timestamp:
-            # 更新時刻をUNIXタイムスタンプで保存
-            url_timestamps[url] = timestamp.timestamp()
-            return timestamp
-        return None
+        try:
+            # リスティングは鮮度判定の元になるため常にサーバーから取得する
+            content = await self.http_client.get(url, use_cache=False)
+            if not content:
+                return {}
+            
+            entries = parse_directory_listing(content.decode('utf-8'))
+            for filename, (update_timestamp, _) in entries.items():
+                url_timestamps[url + filename] = update_timestamp
+            if entries:
+                url_timestamps[url] = max(mtime for mtime, _ in entries.values())
+            return entries
+        except Exception as e:
+            print(f"Error fetching listing for {category}: {e}")
+            traceback.print_exc()
+            return {}
+
+    async def check_category_update_time(self, category):
+        entries = await self.get_listing(category)
+        timestamp, _ = find_first_file_modified(entries)
+        return timestamp
         
     async def get_zip_urls(self, category):
         url = f"{self.base_url}{category}/now/"
+        entries = await self.get_listing(category)
         
-        if USE_SMART_CACHE:
-            cache_key = f"zip_urls_{category}"
-            
-            # カテゴリの更新時刻がすでに取得されている場合、それを利用
-            if url in url_timestamps:
-                cached_urls = get_file_cache(cache_key)
-                if cached_urls:
-                    # メタデータでキャッシュの更新時刻をチェック
-                    cache_path = f"{TMP_CACHE_DIR}/cache_{get_file_cache_key(cache_key)}.meta"
-                    if os.path.exists(cache_path):
-                        with open(cache_path, 'r') as f:
-                            metadata = json.load(f)
-                            cached_update_time = metadata.get('update_time', 0)
-                            if cached_update_time >= url_timestamps[url]:
-                                print(f"Using cached ZIP URLs for category {category} (still current)")
-                                return cached_urls
-                
-                cached_urls = get_memory_cache(cache_key)
-                if cached_urls:
-                    return cached_urls
-        
-        content = await self.http_client.get(url)
-        if not content:
-            return []
-        
-        zip_files = re.findall(r'href="(10minutenwerte_\w+_\d+_now\.zip)"', content.decode('utf-8'))
-        result = [(url + zip_file, category) for zip_file in zip_files]
-        
-        if result and USE_SMART_CACHE:
-            update_time = url_timestamps.get(url)
-            set_memory_cache(cache_key, result)
-            set_file_cache(cache_key, result, update_time)
+        result = []
+        for zip_file, entry in entries.items():
+            if self.station_range:
+                station_id = self.extract_station_id(zip_file)
+                if not station_id or not self.station_range[0] <= int(station_id) <= self.station_range[1]:
+                    continue
+            self.file_entries[url + zip_file] = entry
+            result.append((url + zip_file, category))
             
         return result
 
@@ -516,309 +1116,394 @@ class ZipProcessor:
             }
         }
 
+    STATION_TEMPLATE = {
+        "LCLID": "",
+        "ID_GLOBAL_MNET": "",
+        "ARPRSS": get_missing_value("INT16"),
+        "ARPRSS_AQC": get_missing_value("INT8"),
+        "AIRTMP": get_missing_value("INT16"),
+        "AIRTMP_AQC": get_missing_value("INT8"),
+        "AIRTMP_10MIN_MAX": get_missing_value("INT16"),
+        "AIRTMP_10MIN_MAX_AQC": get_missing_value("INT8"),
+        "AIRTMP_10MIN_MINI": get_missing_value("INT16"),
+        "AIRTMP_10MIN_MINI_AQC": get_missing_value("INT8"),
+        "RHUM": get_missing_value("INT16"),
+        "RHUM_AQC": get_missing_value("INT8"),
+        "DEWTMP": get_missing_value("INT16"),
+        "DEWTMP_AQC": get_missing_value("INT8"),
+        "WNDSPD_10MIN_MAX": get_missing_value("INT16"),
+        "WNDSPD_10MIN_MAX_AQC": get_missing_value("INT8"),
+        "WNDSPD": get_missing_value("INT16"),
+        "WNDSPD_AQC": get_missing_value("INT8"),
+        "WNDDIR": get_missing_value("INT16"),
+        "WNDDIR_AQC": get_missing_value("INT8"),
+        "GUSTS": get_missing_value("INT16"),
+        "GUSTS_AQC": get_missing_value("INT8"),
+        "GUSTD": get_missing_value("INT16"),
+        "GUSTD_AQC": get_missing_value("INT8"),
+        "PRCRIN_10MIN": get_missing_value("INT16"),
+        "PRCRIN_10MIN_AQC": get_missing_value("INT8"),
+        "SCTRAD_10MIN": get_missing_value("INT32"),
+        "SCTRAD_10MIN_AQC": get_missing_value("INT8"),
+        "GLBRAD_10MIN": get_missing_value("INT32"),
+        "GLBRAD_10MIN_AQC": get_missing_value("INT8"),
+        "SUNDUR_10MIN": get_missing_value("INT32"),
+        "SUNDUR_10MIN_AQC": get_missing_value("INT8"),
+    }
+
     @staticmethod
     def create_station_json(station_id):
-        return {
-            "LCLID": str(station_id),
-            "ID_GLOBAL_MNET": f"DWD_{station_id}",
-            "ARPRSS": get_missing_value("INT16"),
-            "ARPRSS_AQC": get_missing_value("INT8"),
-            "AIRTMP": get_missing_value("INT16"),
-            "AIRTMP_AQC": get_missing_value("INT8"),
-            "AIRTMP_10MIN_MAX": get_missing_value("INT16"),
-            "AIRTMP_10MIN_MAX_AQC": get_missing_value("INT8"),
-            "AIRTMP_10MIN_MINI": get_missing_value("INT16"),
-            "AIRTMP_10MIN_MINI_AQC": get_missing_value("INT8"),
-            "RHUM": get_missing_value("INT16"),
-            "RHUM_AQC": get_missing_value("INT8"),
-            "DEWTMP": get_missing_value("INT16"),
-            "DEWTMP_AQC": get_missing_value("INT8"),
-            "WNDSPD_10MIN_MAX": get_missing_value("INT16"),
-            "WNDSPD_10MIN_MAX_AQC": get_missing_value("INT8"),
-            "WNDSPD": get_missing_value("INT16"),
-            "WNDSPD_AQC": get_missing_value("INT8"),
-            "WNDDIR": get_missing_value("INT16"),
-            "WNDDIR_AQC": get_missing_value("INT8"),
-            "GUSTS": get_missing_value("INT16"),
-            "GUSTS_AQC": get_missing_value("INT8"),
-            "GUSTD": get_missing_value("INT16"),
-            "GUSTD_AQC": get_missing_value("INT8"),
-            "PRCRIN_10MIN": get_missing_value("INT16"),
-            "PRCRIN_10MIN_AQC": get_missing_value("INT8"),
-            "SCTRAD_10MIN": get_missing_value("INT32"),
-            "SCTRAD_10MIN_AQC": get_missing_value("INT8"),
-            "GLBRAD_10MIN": get_missing_value("INT32"),
-            "GLBRAD_10MIN_AQC": get_missing_value("INT8"),
-            "SUNDUR_10MIN": get_missing_value("INT32"),
-            "SUNDUR_10MIN_AQC": get_missing_value("INT8"),
-        }
+        station_json = dict(ZipProcessor.STATION_TEMPLATE)
+        station_json["LCLID"] = str(station_id)
+        station_json["ID_GLOBAL_MNET"] = f"DWD_{station_id}"
+        return station_json
+
+    def compile_converters(self, category, headers):
+        """Return ((column_index, target_field, scale, rounded), ...) for a category's header layout."""
+        header_indices = {}
+        for index, header in enumerate(headers):
+            header_indices.setdefault(header, index)
+        return tuple(
+            (header_indices[source_field], target_field) + ELEMENT_SCALES[target_field]
+            for source_field, target_field in self.element_mapping[category].items()
+            if source_field in header_indices
+        )
+
+    def intern_headers(self, category, station_data):
+        """Share one headers tuple per category layout, so converters are compiled per layout."""
+        layouts = self.header_layouts.setdefault(category, {})
+        headers = tuple(station_data['headers'])
+        station_data['headers'] = layouts.setdefault(headers, headers)
 
     @staticmethod
-    def convert_to_float(value):
-        if value in ['---', '', '-9999', '-999']:
-            return get_invalid_value("INT16")  
-        try:
-            converted = float(value.replace(',', '.'))
-            if converted == -999:  
-                return get_invalid_value("INT16")
-            return converted
-        except ValueError:
-            return get_invalid_value("INT16") 
+    def apply_converters(station_json, values, converters):
+        invalid = get_invalid_value("INT16")
+        missing = get_missing_value("INT16")
+        for index, target_field, scale, rounded in converters:
+            try:
+                raw = values[index]
+                if raw in INVALID_RAW_VALUES:
+                    station_json[target_field] = invalid
+                    continue
+                value = float(raw.replace(',', '.'))
+                if value == -999 or value == missing or value == invalid:
+                    station_json[target_field] = invalid
+                    continue
+                value *= scale
+                station_json[target_field] = int(round(value)) if rounded else int(value)
+            except (ValueError, IndexError):
+                station_json[target_field] = invalid
+
+    def add_station(self, station_id, category, station_data):
+        self.intern_headers(category, station_data)
+        if station_id not in self.station_data:
+            self.station_data[station_id] = {}
+        self.station_data[station_id][category] = station_data
+        self.processed_count += 1
 
     async def process_single_zip(self, url_info):
+        # ダウンロードのみ行い、解析はデコードキューを経由してワーカーに任せる
         url, category = url_info
         try:
-            if USE_SMART_CACHE:
-                category_url = f"{self.base_url}{category}/now/"
-                zip_update_time = url_timestamps.get(category_url)
-                
-                if zip_update_time:
-                    cache_key = f"processed_data_{url}"
-                    processed_data = get_file_cache(cache_key)
-                    
-                    if processed_data:
-                        # キャッシュが最新かどうかを確認
-                        cache_path = f"{TMP_CACHE_DIR}/cache_{get_file_cache_key(cache_key)}.meta"
-                        if os.path.exists(cache_path):
-                            with open(cache_path, 'r') as f:
-                                metadata = json.load(f)
-                                cached_update_time = metadata.get('update_time', 0)
-                                if cached_update_time >= zip_update_time:
-                                    # キャッシュが最新
-                                    station_id, station_data = processed_data
-                                    if station_id:
-                                        if station_id not in self.station_data:
-                                            self.station_data[station_id] = {}
-                                        self.station_data[station_id][category] = station_data
-                                        self.processed_count += 1
-                                        if self.processed_count % 100 == 0:
-                                            print(f"Processed {self.processed_count}/{self.total_files} files (from cache)")
-                                        return station_id
-                    
-                    processed_data = get_memory_cache(cache_key)
-                    if processed_data:
-                        station_id, station_data = processed_data
-                        if station_id:
-                            if station_id not in self.station_data:
-                                self.station_data[station_id] = {}
-                            self.station_data[station_id][category] = station_data
-                            self.processed_count += 1
-                            if self.processed_count % 100 == 0:
-                                print(f"Processed {self.processed_count}/{self.total_files} files (from memory)")
-                            return station_id
-
-            # キャッシュになければ、または古ければ新しいデータを取得
-            content = await self.http_client.get(url)
+            content = await self.http_client.get(url, deadline=self.budget.deadline, tag=category)
             
             if not content:
+                if self.budget.exhausted():
+                    self.pending_urls.append(url_info)
                 return None
 
             station_id = self.extract_station_id(url)
             if not station_id:
                 return None
 
-            with zipfile.ZipFile(io.BytesIO(content)) as z:
-                txt_file = [f for f in z.namelist() if f.endswith('.txt')][0]
-                
-                with z.open(txt_file) as f:
-                    text_content = io.TextIOWrapper(f, encoding='utf-8')
-                    csv_reader = csv.reader(text_content, delimiter=';')
-                    rows = list(csv_reader)
-                    
-                    if len(rows) > 1:
-                        headers = rows[0]
-                        data_rows = rows[1:]
-                        if data_rows:
-                            latest_row = max(data_rows, key=lambda x: datetime.strptime(x[1], '%Y%m%d%H%M'))
-                            
-                            station_data = {
-                                'headers': headers,
-                                'data': latest_row
-                            }
-                            
-                            if station_id not in self.station_data:
-                                self.station_data[station_id] = {}
-                            self.station_data[station_id][category] = station_data
-                            
-                            if USE_SMART_CACHE:
-                                cache_key = f"processed_data_{url}"
-                                category_url = f"{self.base_url}{category}/now/"
-                                update_time = url_timestamps.get(category_url)
-                                set_memory_cache(cache_key, (station_id, station_data))
-                                set_file_cache(cache_key, (station_id, station_data), update_time)
-                            
-                            self.processed_count += 1
-                            if self.processed_count % 100 == 0:
-                                print(f"Processed {self.processed_count}/{self.total_files} files (new data)")
-                                
-                            return station_id
+            await self.decode_queue.put((url, station_id, category, content))
+            return station_id
 
         except Exception as e:
             print(f"Error processing {url}: {str(e)}")
             return None
 
-    async def process_batch(self, batch_urls):
-        tasks = [self.process_single_zip(url_info) for url_info in batch_urls]
-        return await asyncio.gather(*tasks)
+    async def decode_worker(self, index):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.decode_queue.get()
+            if item is None:
+                break
+            
+            url, station_id, category, content = item
+            try:
+                if self.decode_pool:
+                    result = await loop.run_in_executor(None, self.decode_pool.run, index, station_id, category, content)
+                else:
+                    result = await asyncio.to_thread(decode_station_zip, station_id, category, content)
+                _, _, headers, latest_row = result
+                
+                if headers and latest_row:
+                    station_data = {
+                        'headers': headers,
+                        'data': latest_row
+                    }
+                    self.add_station(station_id, category, station_data)
+                    
+                    if url in self.file_entries:
+                        self.snapshot.update(url, self.file_entries[url], station_id, station_data)
+                    
+                    if self.processed_count % 100 == 0:
+                        print(f"Processed {self.processed_count}/{self.total_files} files (new data)")
+            except Exception as e:
+                print(f"Error processing {url}: {str(e)}")
+
+    async def download_worker(self):
+        # 期限が近づいたら新しいダウンロードは開始しない
+        while self.pending_urls and not self.budget.exhausted():
+            await self.process_single_zip(self.pending_urls.popleft())
 
-    async def process_all_categories(self):
-        try:
-            validate_env_vars()
-            cleanup_memory_cache()
-            init_file_cache()
+    async def collect_station_data(self):
+        """Fetch the listings, restore unchanged stations and download the changed ones.
 
-            # まず各カテゴリの更新時刻を確認
-            update_tasks = [self.check_category_update_time(category) for category in self.categories]
-            update_times = await asyncio.gather(*update_tasks)
-            
-            # 全カテゴリで最新の更新時刻を使用
-            valid_times = [t for t in update_times if t is not None]
-            if valid_times:
-                latest_observation_time = max(valid_times)
-                print(f"Latest observation time from all categories: {latest_observation_time}")
-            else:
-                print("Could not determine latest observation time from URLs")
-                latest_observation_time = datetime.now(timezone.utc)
+        Returns the candidate observation times found in the listings.
+        """
+        snapshot_task = asyncio.create_task(asyncio.to_thread(self.snapshot.load))
+
+        # HTTPスレッドが起動する前にワーカープロセスをフォークしておく
+        if DECODE_WORKERS > 1:
+            self.decode_pool = DecodeProcessPool(DECODE_WORKERS)
+            print(f"Started {len(self.decode_pool)} decode worker processes")
+
+        # 全カテゴリのリスティングを並列に一度だけ取得し、更新時刻の確認とURL取得で共有
+        update_tasks = [self.check_category_update_time(category) for category in self.categories]
+        update_times = await asyncio.gather(*update_tasks)
+        
+        valid_times = [t for t in update_times if t is not None]
+
+        # 並列でカテゴリごとのURLを取得
+        category_tasks = [self.get_zip_urls(category) for category in self.categories]
+        category_urls = await asyncio.gather(*category_tasks)
+        
+        all_urls = []
+        for urls in category_urls:
+            all_urls.extend(urls)
+
+        self.total_files = len(all_urls)
+        print(f"Found {self.total_files} total files to process")
+
+        await snapshot_task
+        if not all_urls:
+            print("No URLs found to process")
+            return valid_times
+
+        # 前回実行時から更新時刻・サイズが変わっていないZIPはスナップショットの行を再利用
+        changed_urls = []
+        for url, category in all_urls:
+            restored = self.snapshot.get_unchanged(url, self.file_entries[url])
+            if restored:
+                self.add_station(restored[0], category, restored[1])
+                continue
+            changed_urls.append((url, category))
+        print(f"Skipped {len(all_urls) - len(changed_urls)} unchanged files, {len(changed_urls)} files to download")
+
+        # 前回の積み残しと、最後に処理してから最も時間が経っている観測所を優先
+        changed_urls.sort(key=self.snapshot.staleness_key)
+        self.pending_urls = deque(changed_urls)
+        
+        self.decode_queue = asyncio.Queue(maxsize=DECODE_QUEUE_SIZE)
+        decode_count = len(self.decode_pool) if self.decode_pool else 1
+        decode_tasks = [asyncio.create_task(self.decode_worker(i)) for i in range(decode_count)]
+        
+        # 同時実行数の上限までワーカーを起動し、空いたワーカーが優先度順に次のファイルを取る
+        worker_count = min(self.http_client.limiter.maximum, len(changed_urls))
+        download_tasks = [asyncio.create_task(self.download_worker()) for _ in range(worker_count)]
+        await asyncio.gather(*download_tasks)
+        for _ in decode_tasks:
+            await self.decode_queue.put(None)
+        await asyncio.gather(*decode_tasks)
+        
+        # 期限までにダウンロードできなかったファイルは次回の実行に引き継ぐ
+        self.snapshot.pending = {url for url, _ in self.pending_urls}
+        if self.pending_urls:
+            print(f"Time budget exhausted: {len(self.pending_urls)} files deferred to the next run")
+        # 積み残した観測所は前回のスナップショットの行で出力する
+        for url, category in self.pending_urls:
+            restored = self.snapshot.get_last(url)
+            if restored:
+                self.add_station(restored[0], category, restored[1])
+
+        return valid_times
 
-            # 並列でカテゴリごとのURLを取得
-            category_tasks = [self.get_zip_urls(category) for category in self.categories]
-            category_urls = await asyncio.gather(*category_tasks)
+    @staticmethod
+    def resolve_observation_time(valid_times):
+        # 全カテゴリで最新の更新時刻を使用
+        if valid_times:
+            latest_observation_time = max(valid_times)
+            print(f"Latest observation time from all categories: {latest_observation_time}")
+            return latest_observation_time
+        print("Could not determine latest observation time from URLs")
+        return datetime.now(timezone.utc)
+
+    async def publish(self, latest_observation_time, save_snapshot=True):
+        """Write the raw archive and converted JSON for the collected station data."""
+        output_file_name = datetime.now(timezone.utc).strftime('%Y%m%d%H%M')  
+        raw_s3_key = generate_raw_s3_key(tagid, output_file_name)
+        
+        # 生データはカテゴリごとにストリーミングで書き出し、後続の処理と並行してアップロード
+        raw_writer = S3StreamingWriter(s3_client_eu, raw_data_bucket, raw_s3_key, 'text/csv')
+        for category in self.categories:
+            lines = [f"\n=== {category.upper()} ==="]
+            category_stations = {
+                station_id: data[category]
+                for station_id, data in self.station_data.items()
+                if category in data
+            }
             
-            all_urls = []
-            for urls in category_urls:
-                all_urls.extend(urls)
-
-            self.total_files = len(all_urls)
-            print(f"Found {self.total_files} total files to process")
-
-            if not all_urls:
-                print("No URLs found to process")
-                return
-
-            batch_size = 200  
-            batch_tasks = []
-            for i in range(0, len(all_urls), batch_size):
-                batch_urls = all_urls[i:i + batch_size]
-                batch_tasks.append(self.process_batch(batch_urls))
+            if category_stations:
+                first_station = next(iter(category_stations.values()))
+                lines.append(';'.join(first_station['headers']))
+                
+                # ソート処理を最適化
+                sorted_station_ids = sorted(category_stations.keys(), key=lambda x: int(x))
+                for station_id in sorted_station_ids:
+                    lines.append(';'.join(category_stations[station_id]['data']))
+            else:
+                lines.append("No data available for this category")
             
-            # すべてのバッチを並列実行
-            await asyncio.gather(*batch_tasks)
+            lines.append('')
+            raw_writer.write('\n'.join(lines))
+            await asyncio.sleep(0)
+        
+        # JSON生成を高速化
+        json_structure = self.create_json_structure(latest_observation_time)
+        station_jsons = {
+            station_id: ZipProcessor.create_station_json(station_id)
+            for station_id in self.station_data
+        }
+        
+        # カテゴリ・ヘッダー構成ごとに変換表を観測所ループの前に一度だけ作り、全観測所にまとめて適用
+        compiled_converters = {
+            (category, id(headers)): self.compile_converters(category, headers)
+            for category in self.element_mapping
+            for headers in self.header_layouts.get(category, {}).values()
+        }
+        for category in self.element_mapping:
+            for station_id, station_data in self.station_data.items():
+                category_data = station_data.get(category)
+                if category_data:
+                    converters = compiled_converters[(category, id(category_data['headers']))]
+                    self.apply_converters(station_jsons[station_id], category_data['data'], converters)
+        
+        json_structure["original"]["point_data"] = list(station_jsons.values())
 
-            if self.station_data:
-                # S3への保存を準備
-                text_content = ""
-                for category in self.categories:
-                    text_content += f"\n=== {category.upper()} ===\n"
-                    category_stations = {
-                        station_id: data[category]
-                        for station_id, data in self.station_data.items()
-                        if category in data
-                    }
-                    
-                    if category_stations:
-                        first_station = next(iter(category_stations.values()))
-                        text_content += ';'.join(first_station['headers']) + '\n'
-                        
-                        # ソート処理を最適化
-                        sorted_station_ids = sorted(category_stations.keys(), key=lambda x: int(x))
-                        for station_id in sorted_station_ids:
-                            text_content += ';'.join(category_stations[station_id]['data']) + '\n'
-                    else:
-                        text_content += "No data available for this category\n"
-
-                output_file_name = datetime.now(timezone.utc).strftime('%Y%m%d%H%M')  
-                raw_s3_key = generate_raw_s3_key(tagid, output_file_name)
-                
-                # JSON生成を高速化
-                json_structure = self.create_json_structure(latest_observation_time)
-                json_structure["original"]["point_data"] = []  
-                
-                # ステーションデータ処理を最適化
-                for station_id, station_data in self.station_data.items():
-                    station_json = ZipProcessor.create_station_json(station_id)
-                    
-                    # マッピング処理の最適化
-                    for category, mappings in self.element_mapping.items():
-                        if category in station_data:
-                            headers = station_data[category]['headers']
-                            values = station_data[category]['data']
-                            
-                            # ヘッダーインデックスをキャッシュして繰り返し検索を回避
-                            header_indices = {}
-                            for source_field in mappings.keys():
-                                try:
-                                    header_indices[source_field] = headers.index(source_field)
-                                except ValueError:
-                                    header_indices[source_field] = -1
-                            
-                            for source_field, target_field in mappings.items():
-                                idx = header_indices.get(source_field, -1)
-                                if idx >= 0:
-                                    try:
-                                        value = self.convert_to_float(values[idx])
-
-                                        if value != get_missing_value("INT16") and value != get_invalid_value("INT16"):  
-                                            if target_field in ['AIRTMP', 'SFCTMP', 'DEWTMP', 'AIRTMP_10MIN_MAX', 'AIRTMP_10MIN_MINI']:
-                                                value = int(value * 10)
-                                            elif target_field == 'PRCRIN_10MIN':
-                                                value = int(round(value * 10))
-                                            elif target_field in ['SCTRAD_10MIN', 'GLBRAD_10MIN']:
-                                                value = int(round(value * 10000))
-                                            elif target_field == 'SUNDUR_10MIN':
-                                                value = int(round(value * 60))
-                                            elif target_field in ['WNDSPD', 'ARPRSS', 'RHUM', 'GUSTS', 'WNDSPD_10MIN_MAX', 'GUSTD']:
-                                                value = int(round(value * 10)) 
-                                            elif target_field == 'WNDDIR':
-                                                value = int(round(value))
-                                                                        
-                                            station_json[target_field] = value
-                                        else:
-                                            station_json[target_field] = get_invalid_value("INT16") 
-                                    except (ValueError, IndexError):
-                                        station_json[target_field] = get_invalid_value("INT16") 
-
-                    json_structure["original"]["point_data"].append(station_json)
-
-                json_structure["original"]["point_count"] = len(json_structure["original"]["point_data"])
-                
-                current_time = datetime.now(timezone.utc)
-                random_suffix = str(uuid.uuid4())
-                json_file_name = f"{current_time.strftime('%Y%m%d%H%M%S')}.{random_suffix}"
-                conv_s3_key = generate_json_s3_key(tagid, json_file_name)
-                
-                raw_bytes = text_content.encode('utf-8')
-                json_bytes = json.dumps(
-                    json_structure, 
-                    ensure_ascii=False, 
-                    indent=2  
-                ).encode('utf-8')                
-
-                aws_tasks = [
-                    asyncio.to_thread(self.save_to_s3_raw, raw_bytes, raw_s3_key),
-                    asyncio.to_thread(self.save_to_s3_converted, json_bytes, conv_s3_key)
-                ]
-                await asyncio.gather(*aws_tasks)
-
-                print("\nData Summary:")
-                for category in self.categories:
-                    category_count = sum(1 for data in self.station_data.values() if category in data)
-                    print(f"{category.upper()}: {category_count} stations")
-                
-                if latest_observation_time:
-                    print(f"Latest observation time: {latest_observation_time.strftime('%Y-%m-%d %H:%M UTC')}")
-
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps({
-                        'raw_key': raw_s3_key,
-                        'converted_key': conv_s3_key,
-                        'observation_time': latest_observation_time.isoformat() if latest_observation_time else None,
-                        'timestamp': datetime.now(timezone.utc).isoformat()
-                    })
-                }
+        json_structure["original"]["point_count"] = len(json_structure["original"]["point_data"])
+        
+        current_time = datetime.now(timezone.utc)
+        random_suffix = str(uuid.uuid4())
+        json_file_name = f"{current_time.strftime('%Y%m%d%H%M%S')}.{random_suffix}"
+        conv_s3_key = generate_json_s3_key(tagid, json_file_name)
+        
+        json_bytes = json.dumps(
+            json_structure, 
+            ensure_ascii=False, 
+            indent=2  
+        ).encode('utf-8')                
+
+        aws_tasks = [
+            raw_writer.close(),
+            asyncio.to_thread(self.save_to_s3_converted, json_bytes, conv_s3_key)
+        ]
+        if save_snapshot:
+            aws_tasks.append(asyncio.to_thread(self.snapshot.save, self.file_entries))
+        await asyncio.gather(*aws_tasks)
+
+        print("\nData Summary:")
+        for category in self.categories:
+            category_count = sum(1 for data in self.station_data.values() if category in data)
+            print(f"{category.upper()}: {category_count} stations")
+        
+        if latest_observation_time:
+            print(f"Latest observation time: {latest_observation_time.strftime('%Y-%m-%d %H:%M UTC')}")
+        
+        http_stats = self.http_client.limiter.stats()
+        print(f"HTTP concurrency limit: {http_stats['concurrency_limit']} (peak {http_stats['peak_concurrency_limit']}, "
+              f"decreases {http_stats['limit_decreases']}), latency p50/p90/p99: "
+              f"{http_stats['latency_p50']}/{http_stats['latency_p90']}/{http_stats['latency_p99']}s")
+        http_stats['responses'] = self.http_client.response_counts
+        for category, counts in self.http_client.response_counts.items():
+            print(f"{category.upper()}: 200 x {counts['200']} ({counts['bytes_received']/1024:.1f}KB), "
+                  f"304 x {counts['304']} ({counts['bytes_saved']/1024:.1f}KB saved)")
+
+        return {
+            'statusCode': 200,
+            'body': json.dumps({
+                'raw_key': raw_s3_key,
+                'converted_key': conv_s3_key,
+                'observation_time': latest_observation_time.isoformat() if latest_observation_time else None,
+                'http': http_stats,
+                'pending_files': len(self.pending_urls),
+                'timestamp': datetime.now(timezone.utc).isoformat()
+            })
+        }
+
+    def save_partial(self, run_id, valid_times):
+        partial_key = generate_partial_s3_key(tagid, run_id, self.shard_id)
+        payload = {
+            'shard': self.shard_id,
+            'categories': self.categories,
+            'observation_times': [t.isoformat() for t in valid_times],
+            'stations': self.station_data
+        }
+        body = gzip.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+        s3_client_eu.put_object(
+            Body=body,
+            Bucket=raw_data_bucket,
+            Key=partial_key,
+            ContentType='application/json',
+            ContentEncoding='gzip'
+        )
+        print(f"Saved partial result to EU S3: {raw_data_bucket}/{partial_key} ({len(self.station_data)} stations)")
+        return partial_key
+
+    def load_partials(self, run_id):
+        keys = []
+        list_kwargs = {'Bucket': raw_data_bucket, 'Prefix': generate_partial_s3_prefix(tagid, run_id)}
+        while True:
+            response = s3_client_eu.list_objects_v2(**list_kwargs)
+            keys.extend(item['Key'] for item in response.get('Contents', []))
+            if not response.get('IsTruncated'):
+                break
+            list_kwargs['ContinuationToken'] = response['NextContinuationToken']
+        
+        valid_times = []
+        shards = []
+        for key in keys:
+            response = s3_client_eu.get_object(Bucket=raw_data_bucket, Key=key)
+            payload = json.loads(gzip.decompress(response['Body'].read()))
+            for station_id, categories in payload['stations'].items():
+                if station_id not in self.station_data:
+                    self.station_data[station_id] = {}
+                for category, category_data in categories.items():
+                    self.intern_headers(category, category_data)
+                self.station_data[station_id].update(categories)
+            valid_times.extend(datetime.fromisoformat(t) for t in payload['observation_times'])
+            shards.append(payload['shard'])
+        print(f"Loaded {len(shards)} partial results for run {run_id}: {', '.join(shards)}")
+        return valid_times, shards, keys
 
+    def delete_partials(self, keys):
+        # 1リクエストで削除できるのは1000件まで
+        for start in range(0, len(keys), 1000):
+            s3_client_eu.delete_objects(
+                Bucket=raw_data_bucket,
+                Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True}
+            )
+        print(f"Deleted {len(keys)} partial results")
+
+    async def _run(self, stage, context=None):
+        self.budget = TimeBudget(context)
+        try:
+            validate_env_vars()
+            init_file_cache()
+            return await stage()
         except Exception as e:
-            print(f"Error in process_all_categories: {str(e)}")
+            print(f"Error in {stage.__name__}: {str(e)}")
             traceback.print_exc()
             return {
                 'statusCode': 500,
@@ -827,12 +1512,87 @@ class ZipProcessor:
                     'timestamp': datetime.now(timezone.utc).isoformat()
                 })
             }
+        finally:
+            file_cache.save()
+            if self.decode_pool:
+                self.decode_pool.close()
+                self.decode_pool = None
+
+    async def process_all_categories(self, context=None):
+        async def process_all_categories():
+            valid_times = await self.collect_station_data()
+            if self.station_data:
+                return await self.publish(self.resolve_observation_time(valid_times))
+            # 出力するデータがなくても積み残しは次回の実行に引き継ぐ
+            await asyncio.to_thread(self.snapshot.save, self.file_entries)
+        return await self._run(process_all_categories, context)
+
+    async def process_shard(self, run_id, context=None):
+        """Crawl this shard's categories and stations and save an intermediate partial result."""
+        async def process_shard():
+            valid_times = await self.collect_station_data()
+            partial_key, _ = await asyncio.gather(
+                asyncio.to_thread(self.save_partial, run_id, valid_times),
+                asyncio.to_thread(self.snapshot.save, self.file_entries)
+            )
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'partial_key': partial_key,
+                    'shard': self.shard_id,
+                    'stations': len(self.station_data),
+                    'pending_files': len(self.pending_urls),
+                    'timestamp': datetime.now(timezone.utc).isoformat()
+                })
+            }
+        return await self._run(process_shard, context)
+
+    async def merge_partials(self, run_id, context=None):
+        """Combine the partial results of a run and publish them as one converted JSON."""
+        async def merge_partials():
+            valid_times, shards, partial_keys = await asyncio.to_thread(self.load_partials, run_id)
+            if self.station_data:
+                result = await self.publish(self.resolve_observation_time(valid_times), save_snapshot=False)
+                # 配信に成功した run の中間結果は不要なので削除する（失敗時は再実行できるよう残す）
+                await asyncio.to_thread(self.delete_partials, partial_keys)
+                return result
+            print(f"No partial results found for run {run_id}")
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'message': 'No partial results',
+                    'run_id': run_id,
+                    'shards': shards,
+                    'timestamp': datetime.now(timezone.utc).isoformat()
+                })
+            }
+        return await self._run(merge_partials, context)
 
 def main(event=None, context=None):
     try:
         validate_env_vars()
-        processor = ZipProcessor()
-        return asyncio.run(processor.process_all_categories())
+        event = event or {}
+        mode = event.get("mode", "full")
+        # シャードとマージは10分の境界をまたいでも同じ run を指すよう、run_id を明示する
+        run_id = event.get("run_id")
+        if mode in ("shard", "merge") and not run_id:
+            raise ValueError(f"{mode} mode requires a run_id")
+        
+        if mode == "shard":
+            shard_id, categories, station_range = parse_shard_spec(event.get("shard") or {})
+            processor = ZipProcessor(categories=categories, station_range=station_range, shard_id=shard_id)
+            stage = processor.process_shard(run_id, context)
+        elif mode == "merge":
+            processor = ZipProcessor()
+            stage = processor.merge_partials(run_id, context)
+        else:
+            processor = ZipProcessor()
+            stage = processor.process_all_categories(context)
+        
+        try:
+            return asyncio.run(stage)
+        finally:
+            processor.http_client.close()
     except Exception as e:
         print(f"Lambda handler error: {str(e)}")
         traceback.print_exc()
@@ -844,5 +1604,21 @@ def main(event=None, context=None):
             })
         }
 
+def run_local(shards=None):
+    """Run against LocalS3Client; with shard specs, run every shard and then the merge step in process."""
+    global s3_client_eu, s3_client_jp
+    s3_client_eu = s3_client_jp = LocalS3Client()
+    if not shards:
+        return main({}, None)
+    
+    run_id = default_run_id()
+    for shard in shards:
+        print(main({"mode": "shard", "run_id": run_id, "shard": shard}, None))
+    return main({"mode": "merge", "run_id": run_id}, None)
+
 if __name__ == "__main__":
-    main({}, {})
\ No newline at end of file
+    if os.getenv("UseLocalS3"):
+        # カテゴリごとに1シャードとして実行し、最後にマージする
+        print(run_local([{"id": category, "categories": [category]} for category in CATEGORIES]))
+    else:
+        main({}, {})
@@ -1,21 +1,40 @@
 import os
+import re
+import io
 import json
 import uuid
 import csv
 import bz2
+import codecs
+import hashlib
+import multiprocessing
+import urllib.error
 import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 import boto3
 
 s3_client_eu = boto3.client("s3", region_name="ap-northeast-1")
 s3_client_jp = boto3.client("s3", region_name="ap-northeast-1")
 
+STREAM_READ_SIZE = 64 * 1024
+RAW_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+METRICS_NAMESPACE = "DWD_SYNOP"
+PUBLISH_MODES = ("full", "incremental")
+CONVERT_WORKERS = int(os.getenv("ConvertWorkers", "1"))
+MESSAGES_ARRAY_PATTERN = re.compile(r'"messages"\s*:\s*\[')
+JSON_WHITESPACE_PATTERN = re.compile(r'[ \t\n\r]*')
+
 def validate_env_vars():
     """Validate required environment variables"""
     required_vars = ["RawDataBucket", "ConvertedBucket", "tagid", "URL"]
     missing_vars = [var for var in required_vars if not os.getenv(var)]
     if missing_vars:
         raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
+    publish_mode = os.getenv("PublishMode", "full")
+    if publish_mode not in PUBLISH_MODES:
+        raise ValueError(f"Invalid PublishMode: {publish_mode} (expected one of {', '.join(PUBLISH_MODES)})")
 
 class Constants:
     MISSING_INT8 = -99
@@ -40,118 +59,270 @@ def find_value_in_nested_list(nested, target_key):
                 return result
     return None
 
-def count_precipitation_data(data):
-    """Count different types of precipitation data in the raw BUFR JSON"""
-    direct_10min_count = 0
-    one_min_aggregated_count = 0
-    one_hour_count = 0
-    six_hour_count = 0  
-    twelve_hour_count = 0  
-    twenty_four_hour_count = 0
-    other_time_period_count = 0
-    
-    def traverse(node, path=[]):
-        nonlocal direct_10min_count, one_min_aggregated_count, one_hour_count, six_hour_count, twelve_hour_count, twenty_four_hour_count, other_time_period_count
-
-        if isinstance(node, list):
-            has_10min_period = False
-            has_precipitation = False
-            has_1hour_period = False
-            has_6hour_period = False
-            has_12hour_period = False
-            has_24hour_period = False
-            
-            other_time_period = False
-            other_time_period_value = None
-            
-            for item in node:
-                if isinstance(item, dict):
-                    if item.get("key") == "timePeriod":
-                        time_period = item.get("value")
-                        time_unit = item.get("units")
-                        
-                        if time_period == -10 and time_unit == "min":
-                            has_10min_period = True
-                        elif (time_period == -60 and time_unit == "min") or (time_period == -1 and time_unit == "h"):
-                            has_1hour_period = True
-
-                        elif (time_period == -360 and time_unit == "min") or (time_period == -6 and time_unit == "h"):
-                            has_6hour_period = True
-                        elif (time_period == -720 and time_unit == "min") or (time_period == -12 and time_unit == "h"):  # 追加
-                            has_12hour_period = True  
-
-                        elif (time_period == -24 and time_unit == "h") or (time_period == -1440 and time_unit == "min"):
-                            has_24hour_period = True
-                        elif time_unit == "min" or time_unit == "h":
-                            other_time_period = True
-                            other_time_period_value = f"{time_period} {time_unit}"
-                    
-                    elif item.get("key") == "totalPrecipitationOrTotalWaterEquivalent" and item.get("value") is not None:
-                        has_precipitation = True
-            
-            if has_10min_period and has_precipitation:
-                direct_10min_count += 1
-            
-            elif has_1hour_period and has_precipitation:
-                one_hour_count += 1
-
-            elif has_6hour_period and has_precipitation:  
-                six_hour_count += 1  
+HEADER_TIME_KEYS = ("typicalYear", "typicalMonth", "typicalDay", "typicalHour", "typicalMinute")
+
+PRECIP_COUNT_KEYS = (
+    "direct_10min_count",
+    "one_min_aggregated_count",
+    "one_hour_count",
+    "six_hour_count",
+    "twelve_hour_count",
+    "twenty_four_hour_count",
+    "other_time_period_count"
+)
+# 1つのリストに複数の時間帯がある場合はこの順で最初に該当したものを数える
+PRECIP_COUNT_ORDER = (
+    "direct_10min_count",
+    "one_hour_count",
+    "six_hour_count",
+    "twelve_hour_count",
+    "twenty_four_hour_count",
+    "other_time_period_count"
+)
+
+# 降水量の時間帯（分）と出力要素の対応
+PRECIP_PERIOD_FIELDS = {
+    -10: "PRCRIN_10MIN",
+    -60: "PRCRIN_1HOUR",
+    -360: "PRCRIN_6HOUR",
+    -720: "PRCRIN_12HOUR",
+    -1440: "PRCRIN_24HOUR"
+}
+PERIOD_UNIT_MINUTES = {"min": 1, "h": 60}
+ONE_MINUTE_SERIES = "ONE_MINUTE_SERIES"
+OTHER_PERIOD = "OTHER_PERIOD"
+PRECIP_COUNT_BY_FIELD = {
+    "PRCRIN_10MIN": "direct_10min_count",
+    "PRCRIN_1HOUR": "one_hour_count",
+    "PRCRIN_6HOUR": "six_hour_count",
+    "PRCRIN_12HOUR": "twelve_hour_count",
+    "PRCRIN_24HOUR": "twenty_four_hour_count"
+}
+
+def build_precip_period_table():
+    """Expand PRECIP_PERIOD_FIELDS into a (timePeriod, units) -> field table"""
+    table = {}
+    for minutes, field in PRECIP_PERIOD_FIELDS.items():
+        for unit, unit_minutes in PERIOD_UNIT_MINUTES.items():
+            if minutes % unit_minutes == 0:
+                table[(minutes // unit_minutes, unit)] = field
+    # 1分値×10の系列は子リストを合計して10分間降水量にする
+    table[(-1, "min")] = ONE_MINUTE_SERIES
+    return table
+
+PRECIP_PERIOD_TABLE = build_precip_period_table()
+# 表にある値は単位が違っていても「その他の時間帯」にしない（従来の判定と同じ）
+KNOWN_PERIOD_VALUES = frozenset(value for value, _ in PRECIP_PERIOD_TABLE)
+
+def classify_precip_period(time_period, time_unit):
+    """Return the PRCRIN field, ONE_MINUTE_SERIES or OTHER_PERIOD of a timePeriod, or None"""
+    if isinstance(time_period, (int, float)):
+        kind = PRECIP_PERIOD_TABLE.get((time_period, time_unit))
+        if kind is not None:
+            return kind
+        if time_period in KNOWN_PERIOD_VALUES:
+            return None
+    if time_period is not None and time_unit in ("min", "h"):
+        return OTHER_PERIOD
+    return None
 
-            elif has_12hour_period and has_precipitation:  
-                twelve_hour_count += 1  
+def precip_count_key(time_period, time_unit):
+    """Return the precipitation counter a timePeriod belongs to"""
+    count_key = PRECIP_COUNT_BY_FIELD.get(classify_precip_period(time_period, time_unit))
+    if count_key is None and time_unit in ("min", "h"):
+        return "other_time_period_count"
+    return count_key
+
+def new_precip_counts():
+    return dict.fromkeys(PRECIP_COUNT_KEYS, 0)
+
+class SubsetIndex:
+    """Key-to-value index of a BUFR subset built in a single walk.
+
+    values holds the first non-None value of each key in the same depth-first
+    order as find_value_in_nested_list, so field lookups are dict hits. The
+    same walk records the 2 m air temperature, the PRCRIN_* values (later
+    periods overwrite earlier ones) with the non-standard periods found, and,
+    when precip_counts is given, the precipitation statistics of every list.
+    """
+
+    def __init__(self, node=None, precip_counts=None):
+        self.values = {}
+        self.temperature_2m = None
+        self.precip_fields = {}
+        self.other_periods = []
+        self.precip_counts = precip_counts
+        if node is not None:
+            self.walk(node)
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def walk(self, node, search_temperature=True):
+        if isinstance(node, dict):
+            key = node.get("key")
+            if key is not None and key not in self.values:
+                value = node.get("value")
+                if value is not None:
+                    self.values[key] = value
+            for value in node.values():
+                if isinstance(value, (list, dict)):
+                    self.walk(value, search_temperature)
+        elif isinstance(node, list):
+            # リスト自身の要素を子要素より先に調べる（従来の再帰探索と同じ順序）
+            search_temperature = self._scan_list(node, search_temperature)
+            for item in node:
+                if isinstance(item, (list, dict)):
+                    self.walk(item, search_temperature)
+
+    def _scan_list(self, node, search_temperature):
+        """Read the period/height context of one list and return whether to keep looking for the 2 m temperature below it."""
+        time_period = None
+        time_unit = None
+        has_2m_height = False
+        temperature_found = False
+        temperature = None
+        precip_values = []
+        count_keys = set()
+        has_1min_period = False
+
+        for item in node:
+            if not isinstance(item, dict):
+                continue
+            key = item.get("key")
+            if key == "timePeriod":
+                time_period = item.get("value")
+                time_unit = item.get("units")
+                count_keys.add(precip_count_key(time_period, time_unit))
+                if time_period == -1 and time_unit == "min":
+                    has_1min_period = True
+            elif key == "totalPrecipitationOrTotalWaterEquivalent":
+                precip_values.append(item.get("value"))
+
+            if search_temperature and not temperature_found and self.temperature_2m is None:
+                if key == "heightOfSensorAboveLocalGroundOrDeckOfMarinePlatform" and item.get("value") == 2:
+                    has_2m_height = True
+                elif has_2m_height and key == "airTemperature":
+                    temperature_found = True
+                    temperature = item.get("value")
+
+        if temperature_found:
+            # 最初に見つかった2m気温を使う（後続の兄弟リストでは上書きしない）
+            if temperature is not None and self.temperature_2m is None:
+                self.temperature_2m = temperature
+            search_temperature = False
+
+        if self.precip_counts is not None:
+            self._count_precipitation(node, count_keys, precip_values, has_1min_period)
+
+        if time_period is not None:
+            self._classify_precip(node, time_period, time_unit, precip_values)
+        return search_temperature
+
+    def _classify_precip(self, node, time_period, time_unit, precip_values):
+        kind = classify_precip_period(time_period, time_unit)
+        if kind == ONE_MINUTE_SERIES:
+            self._add_one_minute_series(node)
+        elif kind == OTHER_PERIOD:
+            other_period = f"{time_period} {time_unit}"
+            for value in precip_values:
+                self.other_periods.append((other_period, value is not None))
+                if value is not None:
+                    self.precip_fields["PRCRIN_10MIN"] = Constants.INVALID_INT16
+                    self.precip_fields["PRCRIN_1HOUR"] = Constants.INVALID_INT16
+                    self.precip_fields["PRCRIN_24HOUR"] = Constants.INVALID_INT16
+        elif kind is not None:
+            for value in precip_values:
+                self._set_precip(kind, value)
+
+    def _set_precip(self, field, value):
+        if value is not None:
+            try:
+                self.precip_fields[field] = int(float(value))
+            except (ValueError, TypeError):
+                pass
 
-            elif has_24hour_period and has_precipitation:
-                twenty_four_hour_count += 1
-        
-            elif other_time_period and has_precipitation:
-                other_time_period_count += 1
-                
-            if len(node) >= 2:
-                has_1min_period = False
-                has_time_increment = False
-                has_replication_factor = False
-                precipitation_values = []
-                
-                for item in node:
-                    if isinstance(item, dict) and item.get("key") == "timePeriod" and item.get("value") == -1 and item.get("units") == "min":
-                        has_1min_period = True
-                        break
-                
-                if has_1min_period:
-                    for item in node:
-                        if isinstance(item, list):
-                            for subitem in item:
-                                if isinstance(subitem, dict):
-                                    if subitem.get("key") == "timeIncrement" and subitem.get("value") == 1:
-                                        has_time_increment = True
-                                    elif subitem.get("key") == "delayedDescriptorReplicationFactor" and subitem.get("value") == 10:
-                                        has_replication_factor = True
-                                    elif subitem.get("key") == "totalPrecipitationOrTotalWaterEquivalent":
-                                        precipitation_values.append(subitem)
-                
-                if has_1min_period and has_time_increment and has_replication_factor and len(precipitation_values) == 10:
-                    one_min_aggregated_count += 1
-            
+    def _add_one_minute_series(self, node):
+        for item in node:
+            if isinstance(item, list):
+                increment_val = None
+                replication_val = None
+                local_precip_values = []
+
+                for subitem in item:
+                    if isinstance(subitem, dict):
+                        if subitem.get("key") == "timeIncrement":
+                            increment_val = subitem.get("value")
+                        elif subitem.get("key") == "delayedDescriptorReplicationFactor":
+                            replication_val = subitem.get("value")
+                        elif subitem.get("key") == "totalPrecipitationOrTotalWaterEquivalent":
+                            local_precip_values.append(subitem.get("value"))
+
+                if increment_val == 1 and replication_val == 10 and len(local_precip_values) == 10:
+                    total_value = sum(float(val) for val in local_precip_values if val is not None)
+                    self._set_precip("PRCRIN_10MIN", total_value)
+
+    def _count_precipitation(self, node, count_keys, precip_values, has_1min_period):
+        if any(value is not None for value in precip_values):
+            for count_key in PRECIP_COUNT_ORDER:
+                if count_key in count_keys:
+                    self.precip_counts[count_key] += 1
+                    break
+
+        if has_1min_period and len(node) >= 2:
+            has_time_increment = False
+            has_replication_factor = False
+            precipitation_count = 0
             for item in node:
-                traverse(item, path + [node])
-                
-        elif isinstance(node, dict):
-            for value in node.values():
-                traverse(value, path + [node])
-    
-    for message in data.get("messages", []):
-        traverse(message)
-    
-    return {
-        "direct_10min_count": direct_10min_count,
-        "one_min_aggregated_count": one_min_aggregated_count,
-        "one_hour_count": one_hour_count,
-        "six_hour_count": six_hour_count,
-        "twelve_hour_count": twelve_hour_count,
-        "twenty_four_hour_count": twenty_four_hour_count,
-        "other_time_period_count": other_time_period_count
-    }
+                if isinstance(item, list):
+                    for subitem in item:
+                        if isinstance(subitem, dict):
+                            key = subitem.get("key")
+                            if key == "timeIncrement" and subitem.get("value") == 1:
+                                has_time_increment = True
+                            elif key == "delayedDescriptorReplicationFactor" and subitem.get("value") == 10:
+                                has_replication_factor = True
+                            elif key == "totalPrecipitationOrTotalWaterEquivalent":
+                                precipitation_count += 1
+            if has_time_increment and has_replication_factor and precipitation_count == 10:
+                self.precip_counts["one_min_aggregated_count"] += 1
+
+def index_message(message, precip_counts=None):
+    """Index the header and every subset of a BUFR message in one walk"""
+    header = SubsetIndex(precip_counts=precip_counts)
+    if isinstance(message, list):
+        header._scan_list(message, False)
+    subsets = None
+    for item in message:
+        if subsets is None and isinstance(item, list):
+            header._scan_list(item, False)
+            subsets = [SubsetIndex(subset, precip_counts) for subset in item]
+            # ヘッダーに無い時刻キーはサブセット内の最初の値を使う（従来の探索順と同じ）
+            for key in HEADER_TIME_KEYS:
+                if key not in header.values:
+                    for subset in subsets:
+                        if key in subset.values:
+                            header.values[key] = subset.values[key]
+                            break
+        else:
+            header.walk(item)
+    return header, subsets or []
+
+def emit_precipitation_metrics(precip_counts, tagid):
+    """Log the precipitation counters as one CloudWatch Embedded Metric Format record"""
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(datetime.now(timezone.utc).timestamp() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [["tagid"]],
+                "Metrics": [{"Name": key, "Unit": "Count"} for key in PRECIP_COUNT_KEYS]
+            }]
+        },
+        "log": "PRECIP LOG",
+        "tagid": tagid,
+        **precip_counts
+    }))
 
 def convert_kelvin_to_tenths_celsius(value_str):
     """Convert Kelvin to tenths of Celsius"""
@@ -231,63 +402,46 @@ def load_weather_codes(csv_path=None):
             mapping[code] = full_description
     return mapping
 
-def create_geojson_from_raw_data(data):
-    """Create GeoJSON from raw BUFR data with actual coordinates"""
-    latest_stations = {}
+def station_geometry(index, timestamp_str):
+    """Return (station_name, coordinates) of one indexed subset"""
+    station_name = index.get("stationOrSiteName") or "UNKNOWN"
     
-    for message in data.get("messages", []):
-        header_time = {
-            "year": find_value_in_nested_list(message, "typicalYear") or -9999,
-            "month": find_value_in_nested_list(message, "typicalMonth") or -9999,
-            "day": find_value_in_nested_list(message, "typicalDay") or -9999,
-            "hour": find_value_in_nested_list(message, "typicalHour") or -9999,
-            "minute": find_value_in_nested_list(message, "typicalMinute") or -9999
-        }
-        
-        subsets = []
-        for item in message:
-            if isinstance(item, list):
-                subsets = item
-                break
-                
-        for subset in subsets:
-            station_name = find_value_in_nested_list(subset, "stationOrSiteName") or "UNKNOWN"
-            
-            lat_raw = find_value_in_nested_list(subset, "latitude")
-            lon_raw = find_value_in_nested_list(subset, "longitude")
-            alt_raw = find_value_in_nested_list(subset, "heightOfStationGroundAboveMeanSeaLevel")
-            
-            if lat_raw in [None, ""] or lon_raw in [None, ""]:
-                lat_f, lon_f, alt_f = 0.0, 0.0, 0.0
+    lat_raw = index.get("latitude")
+    lon_raw = index.get("longitude")
+    alt_raw = index.get("heightOfStationGroundAboveMeanSeaLevel")
+    
+    if lat_raw in [None, ""] or lon_raw in [None, ""]:
+        lat_f, lon_f, alt_f = 0.0, 0.0, 0.0
+        include_alt = False
+    else:
+        try:
+            lat_f = float(lat_raw)
+            lon_f = float(lon_raw)
+        except ValueError:
+            lat_f, lon_f, alt_f = 0.0, 0.0, 0.0
+            include_alt = False
+        else:
+            if alt_raw in [None, ""]:
+                alt_f = None
                 include_alt = False
             else:
                 try:
-                    lat_f = float(lat_raw)
-                    lon_f = float(lon_raw)
+                    alt_f = float(alt_raw)
+                    include_alt = True
                 except ValueError:
-                    lat_f, lon_f, alt_f = 0.0, 0.0, 0.0
+                    alt_f = None
                     include_alt = False
-                else:
-                    if alt_raw in [None, ""]:
-                        alt_f = None
-                        include_alt = False
-                    else:
-                        try:
-                            alt_f = float(alt_raw)
-                            include_alt = True
-                        except ValueError:
-                            alt_f = None
-                            include_alt = False
-            
-            timestamp_str = f"{header_time['year']:04d}-{header_time['month']:02d}-{header_time['day']:02d} {header_time['hour']:02d}:{header_time['minute']:02d}"
-            latest_stations[station_name] = {
-                "timestamp": timestamp_str,
-                "lon": lon_f,
-                "lat": lat_f,
-                "alt": alt_f,
-                "include_alt": include_alt
-            }
     
+    return station_name, {
+        "timestamp": timestamp_str,
+        "lon": lon_f,
+        "lat": lat_f,
+        "alt": alt_f,
+        "include_alt": include_alt
+    }
+
+def build_station_geojson(latest_stations):
+    """Build the station GeoJSON from collected coordinates"""
     features = []
     for st_name, info in latest_stations.items():
         if info.get("include_alt"):
@@ -315,8 +469,316 @@ def create_geojson_from_raw_data(data):
     }
     return geojson
 
+def format_header_timestamp(header):
+    header_time = [header.get(key) or -9999 for key in HEADER_TIME_KEYS]
+    return "{:04d}-{:02d}-{:02d} {:02d}:{:02d}".format(*header_time)
+
+def create_geojson_from_raw_data(data):
+    """Create GeoJSON from raw BUFR data with actual coordinates"""
+    latest_stations = {}
+    for message in data.get("messages", []):
+        header, subset_indexes = index_message(message)
+        header_timestamp = format_header_timestamp(header)
+        for index in subset_indexes:
+            station_name, geometry = station_geometry(index, header_timestamp)
+            latest_stations[station_name] = geometry
+    return build_station_geojson(latest_stations)
+
 def process_structured_json(bufr_data, tagid):
     """Create structured JSON from BUFR data"""
+    return convert_messages(bufr_data.get("messages", []), tagid)
+
+def build_point_record(index, station_name, weather_mapping, warnings):
+    """Convert one indexed subset into an output point; log lines are appended to warnings"""
+    point_dict = {}
+    point_dict["LCLID"] = station_name
+    point_dict["ID_GLOBAL_MNET"] = f"DWD_{station_name}"
+
+    airtmp_at_2m = index.temperature_2m
+    
+    if airtmp_at_2m is not None:
+        point_dict["AIRTMP"] = convert_kelvin_to_tenths_celsius(str(airtmp_at_2m))
+    else:
+        airtmp_str = index.get("airTemperature")
+        point_dict["AIRTMP"] = convert_kelvin_to_tenths_celsius(airtmp_str)
+    
+    point_dict["AIRTMP_AQC"] = Constants.MISSING_INT8
+
+    point_dict["PRCRIN_10MIN"] = Constants.MISSING_INT16
+    point_dict["PRCRIN_10MIN_AQC"] = Constants.MISSING_INT8
+    point_dict["PRCRIN_1HOUR"] = Constants.MISSING_INT16
+    point_dict["PRCRIN_1HOUR_AQC"] = Constants.MISSING_INT8
+    point_dict["PRCRIN_24HOUR"] = Constants.MISSING_INT16
+    point_dict["PRCRIN_24HOUR_AQC"] = Constants.MISSING_INT8
+
+    for other_period, _ in index.other_periods:
+        warnings.append(f"[WARNING] Found precipitation data with non-standard time period: {other_period}")
+
+    point_dict["PRCRIN_10MIN"] = Constants.MISSING_INT16
+    point_dict["PRCRIN_10MIN_AQC"] = Constants.MISSING_INT8
+    point_dict["PRCRIN_1HOUR"] = Constants.MISSING_INT16
+    point_dict["PRCRIN_1HOUR_AQC"] = Constants.MISSING_INT8
+    point_dict["PRCRIN_6HOUR"] = Constants.MISSING_INT16
+    point_dict["PRCRIN_6HOUR_AQC"] = Constants.MISSING_INT8
+    point_dict["PRCRIN_12HOUR"] = Constants.MISSING_INT16  
+    point_dict["PRCRIN_12HOUR_AQC"] = Constants.MISSING_INT8  
+    point_dict["PRCRIN_24HOUR"] = Constants.MISSING_INT16
+    point_dict["PRCRIN_24HOUR_AQC"] = Constants.MISSING_INT8
+    point_dict.update(index.precip_fields)
+    for other_period, has_value in index.other_periods:
+        if has_value:
+            warnings.append(f"[WARNING] Station {station_name}: Using INVALID_INT16 for precipitation with period {other_period}")
+
+    point_dict["SNWDPT"] = Constants.MISSING_INT16
+    point_dict["SNWDPT_AQC"] = Constants.MISSING_INT8
+
+    snow_depth_str = index.get("totalSnowDepth")
+    point_dict["SNWDPT"] = convert_m_to_cm(snow_depth_str)
+    point_dict["SNWDPT_AQC"] = Constants.MISSING_INT8
+
+    cloud_str = index.get("cloudCoverTotal")
+    if cloud_str is not None:
+        try:
+            point_dict["AMTCLD"] = int(float(cloud_str))
+        except ValueError:
+            point_dict["AMTCLD"] = Constants.MISSING_INT16
+    else:
+        point_dict["AMTCLD"] = Constants.MISSING_INT16
+    point_dict["AMTCLD_AQC"] = Constants.MISSING_INT8
+
+    hvis_str = index.get("horizontalVisibility")
+    if hvis_str in [None, "", "--", "-"]:
+        point_dict["HVIS"] = Constants.MISSING_INT32
+    else:
+        point_dict["HVIS"] = convert_to_int_with_factor(hvis_str, factor=1)
+    point_dict["HVIS_AQC"] = Constants.MISSING_INT8
+
+    gust_dir_str = index.get("maximumWindGustDirection")
+    point_dict["GUSTD"] = convert_to_int_with_factor(gust_dir_str, factor=1)
+    point_dict["GUSTD_AQC"] = Constants.MISSING_INT8
+
+    gust_speed_str = index.get("maximumWindGustSpeed")
+    if gust_speed_str is not None:
+        try:
+            point_dict["GUSTS"] = int(float(gust_speed_str) * 10)
+        except ValueError:
+            point_dict["GUSTS"] = Constants.MISSING_INT16
+    else:
+        point_dict["GUSTS"] = Constants.MISSING_INT16
+    point_dict["GUSTS_AQC"] = Constants.MISSING_INT8
+
+    w10m_str = index.get("maximumWindSpeed10MinuteMeanWind")
+    point_dict["WNDSPD_10MIN_AVG"] = convert_to_int_with_factor(w10m_str, factor=10)
+    point_dict["WNDSPD_10MIN_AVG_AQC"] = Constants.MISSING_INT8
+
+    mini_tmp_str = index.get("minimumTemperatureAt2M")
+    point_dict["AIRTMP_1HOUR_MINI"] = convert_kelvin_to_tenths_celsius(mini_tmp_str)
+    point_dict["AIRTMP_1HOUR_MINI_AQC"] = Constants.MISSING_INT8
+
+    max_tmp_str = index.get("maximumTemperatureAt2M")
+    point_dict["AIRTMP_1HOUR_MAX"] = convert_kelvin_to_tenths_celsius(max_tmp_str)
+    point_dict["AIRTMP_1HOUR_MAX_AQC"] = Constants.MISSING_INT8
+
+    dew_str = index.get("dewpointTemperature")
+    point_dict["DEWTMP"] = convert_kelvin_to_tenths_celsius(dew_str)
+    point_dict["DEWTMP_AQC"] = Constants.MISSING_INT8
+
+    rhum_str = index.get("relativeHumidity")
+    if rhum_str is not None:
+        try:
+            point_dict["RHUM"] = int(float(rhum_str) * 10)
+        except ValueError:
+            point_dict["RHUM"] = Constants.MISSING_INT16
+    else:
+        point_dict["RHUM"] = Constants.MISSING_INT16
+    point_dict["RHUM_AQC"] = Constants.MISSING_INT8
+
+    press_str = index.get("nonCoordinatePressure")
+    if press_str is not None:
+        try:
+            point_dict["ARPRSS"] = int(float(press_str) / 100.0 * 10)
+        except ValueError:
+            point_dict["ARPRSS"] = Constants.MISSING_INT16
+    else:
+        point_dict["ARPRSS"] = Constants.MISSING_INT16
+    point_dict["ARPRSS_AQC"] = Constants.MISSING_INT8
+
+    mslp_str = index.get("pressureReducedToMeanSeaLevel")
+    if mslp_str is not None:
+        try:
+            point_dict["SSPRSS"] = int(float(mslp_str) / 100.0 * 10)
+        except ValueError:
+            point_dict["SSPRSS"] = Constants.MISSING_INT16
+    else:
+        point_dict["SSPRSS"] = Constants.MISSING_INT16
+    point_dict["SSPRSS_AQC"] = Constants.MISSING_INT8
+
+    windspd_str = index.get("windSpeed")
+    if windspd_str is not None:
+        try:
+            point_dict["WNDSPD"] = int(float(windspd_str) * 10)
+        except ValueError:
+            point_dict["WNDSPD"] = Constants.MISSING_INT16
+    else:
+        point_dict["WNDSPD"] = Constants.MISSING_INT16
+    point_dict["WNDSPD_AQC"] = Constants.MISSING_INT8
+
+    rad_str = index.get("globalSolarRadiationIntegratedOverPeriodSpecified")
+    if rad_str is not None:
+        try:
+            point_dict["GLBRAD_1HOUR"] = int(float(rad_str))
+        except ValueError:
+            point_dict["GLBRAD_1HOUR"] = Constants.MISSING_INT16
+    else:
+        point_dict["GLBRAD_1HOUR"] = Constants.MISSING_INT16
+    point_dict["GLBRAD_1HOUR_AQC"] = Constants.MISSING_INT8
+
+    wx_str = index.get("presentWeather")
+    code = convert_to_int(wx_str, missing=Constants.MISSING_INT16)
+    if code == Constants.MISSING_INT16 or code not in weather_mapping:
+        weather_str = ""
+    else:
+        weather_str = weather_mapping.get(code, "")
+    point_dict["WX_original"] = weather_str
+    point_dict["WX_original_AQC"] = Constants.MISSING_INT8
+
+    return point_dict
+
+def convert_message(message, weather_mapping, latest_times, precip_counts, watermarks=None, incremental=False, with_stations=False):
+    """Convert one BUFR message into per-station candidates
+
+    latest_times maps each station to the newest observation time seen so far
+    and is updated in place; only subsets newer than it are converted.
+    Returns (candidates, stations): candidates are (station_name, timestamp,
+    point_dict, warnings) tuples in subset order, stations are (station_name,
+    coordinates) pairs of every subset when with_stations is set.
+    """
+    header, subset_indexes = index_message(message, precip_counts)
+    header_year = header.get("typicalYear") or -9999
+    header_month = header.get("typicalMonth") or -9999
+    header_day = header.get("typicalDay") or -9999
+    header_hour = header.get("typicalHour") or -9999
+    header_minute = header.get("typicalMinute") or -9999
+
+    stations = []
+    if with_stations:
+        header_timestamp = format_header_timestamp(header)
+        stations = [station_geometry(index, header_timestamp) for index in subset_indexes]
+
+    candidates = []
+    for index in subset_indexes:
+        station_name = index.get("stationOrSiteName") or "UNKNOWN"
+        year = index.get("year") or header_year
+        month = index.get("month") or header_month
+        day = index.get("day") or header_day
+        hour = index.get("hour") or header_hour
+        minute = index.get("minute") or header_minute
+        
+        timestamp_str = f"{year:04d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}"
+        
+        if station_name in latest_times and timestamp_str <= latest_times[station_name]:
+            continue
+        if incremental and timestamp_str <= watermarks.get(station_name, ""):
+            continue
+
+        warnings = []
+        point_dict = build_point_record(index, station_name, weather_mapping, warnings)
+        latest_times[station_name] = timestamp_str
+        candidates.append((station_name, timestamp_str, point_dict, warnings))
+
+    return candidates, stations
+
+def merge_candidates(unique_records, candidates):
+    """Keep the newest record of each station; on equal times the earlier one wins"""
+    for station_name, timestamp_str, point_dict, warnings in candidates:
+        if station_name in unique_records and timestamp_str <= unique_records[station_name]["timestamp"]:
+            continue
+        for warning in warnings:
+            print(warning)
+        unique_records[station_name] = {"timestamp": timestamp_str, "data": point_dict}
+
+def _convert_worker_loop(conn, weather_mapping, watermarks, incremental, with_stations):
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        try:
+            precip_counts = new_precip_counts()
+            candidates, stations = convert_message(
+                message, weather_mapping, {}, precip_counts, watermarks, incremental, with_stations
+            )
+            conn.send((True, (candidates, stations, precip_counts)))
+        except Exception as e:
+            conn.send((False, str(e)))
+    conn.close()
+
+class ConvertProcessPool:
+    """Worker processes connected by multiprocessing.Pipe.
+
+    Lambda has no /dev/shm, so ProcessPoolExecutor and multiprocessing.Queue
+    cannot be used there; each worker is driven over its own pipe instead.
+    """
+
+    def __init__(self, workers, *settings):
+        self.processes = []
+        self.connections = []
+        for _ in range(workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_convert_worker_loop, args=(child_conn, *settings), daemon=True)
+            process.start()
+            child_conn.close()
+            self.processes.append(process)
+            self.connections.append(parent_conn)
+
+    def map(self, messages):
+        """Send messages to the workers in turn and yield their results in input order"""
+        in_flight = deque()
+        for number, message in enumerate(messages):
+            # 各ワーカーには1件ずつしか送らない（送信と受信が互いに詰まらないように）
+            if len(in_flight) == len(self.connections):
+                yield self._receive(in_flight.popleft())
+            conn = self.connections[number % len(self.connections)]
+            conn.send(message)
+            in_flight.append(conn)
+        while in_flight:
+            yield self._receive(in_flight.popleft())
+
+    @staticmethod
+    def _receive(conn):
+        ok, result = conn.recv()
+        if not ok:
+            raise ValueError(result)
+        return result
+
+    def close(self):
+        for conn in self.connections:
+            try:
+                conn.send(None)
+                conn.close()
+            except Exception:
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+def convert_messages(messages, tagid, latest_stations=None, watermarks=None, incremental=False, workers=None):
+    """Create structured JSON from an iterable of BUFR messages
+
+    Messages are converted one at a time, so they can come straight from
+    iter_bufr_messages. When latest_stations is given, station coordinates
+    are collected into it from the same subset indexes.
+
+    watermarks maps each station to the last observation time published and
+    only moves forward with the records in the output. With incremental=True only
+    observations newer than the watermark are output.
+
+    With more than one worker, messages are converted in worker processes
+    and the newest record per station is chosen here in message order, so
+    the output is the same as the serial conversion.
+    """
+    if workers is None:
+        workers = CONVERT_WORKERS
     try:
         weather_mapping = load_weather_codes()
     except Exception as e:
@@ -324,305 +786,38 @@ def process_structured_json(bufr_data, tagid):
         weather_mapping = {}
     
     unique_records = {}
-    for message in bufr_data.get("messages", []):
-        header_year = find_value_in_nested_list(message, "typicalYear") or -9999
-        header_month = find_value_in_nested_list(message, "typicalMonth") or -9999
-        header_day = find_value_in_nested_list(message, "typicalDay") or -9999
-        header_hour = find_value_in_nested_list(message, "typicalHour") or -9999
-        header_minute = find_value_in_nested_list(message, "typicalMinute") or -9999
-
-        subsets = []
-        for item in message:
-            if isinstance(item, list):
-                subsets = item
-                break
-
-        for subset in subsets:
-            station_name = find_value_in_nested_list(subset, "stationOrSiteName") or "UNKNOWN"
-            year = find_value_in_nested_list(subset, "year") or header_year
-            month = find_value_in_nested_list(subset, "month") or header_month
-            day = find_value_in_nested_list(subset, "day") or header_day
-            hour = find_value_in_nested_list(subset, "hour") or header_hour
-            minute = find_value_in_nested_list(subset, "minute") or header_minute
-            
-            timestamp_str = f"{year:04d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}"
-            
-            if station_name in unique_records and timestamp_str <= unique_records[station_name]["timestamp"]:
-                continue
-
-            point_dict = {}
-            point_dict["LCLID"] = station_name
-            point_dict["ID_GLOBAL_MNET"] = f"DWD_{station_name}"
-
-            airtmp_at_2m = None
-            
-            def find_temperature_at_2m(node):
-                if isinstance(node, list):
-                    has_2m_height = False
-                    temp_value = None
-                    
-                    for item in node:
-                        if isinstance(item, dict):
-                            if item.get("key") == "heightOfSensorAboveLocalGroundOrDeckOfMarinePlatform" and item.get("value") == 2:
-                                has_2m_height = True
-                            elif has_2m_height and item.get("key") == "airTemperature":
-                                temp_value = item.get("value")
-                                return temp_value
-                    
-                    for item in node:
-                        result = find_temperature_at_2m(item)
-                        if result is not None:
-                            return result
-                    
-                elif isinstance(node, dict):
-                    for value in node.values():
-                        if isinstance(value, (list, dict)):
-                            result = find_temperature_at_2m(value)
-                            if result is not None:
-                                return result
-                
-                return None
-            
-            airtmp_at_2m = find_temperature_at_2m(subset)
-            
-            if airtmp_at_2m is not None:
-                point_dict["AIRTMP"] = convert_kelvin_to_tenths_celsius(str(airtmp_at_2m))
-            else:
-                airtmp_str = find_value_in_nested_list(subset, "airTemperature")
-                point_dict["AIRTMP"] = convert_kelvin_to_tenths_celsius(airtmp_str)
-            
-            point_dict["AIRTMP_AQC"] = Constants.MISSING_INT8
-
-            point_dict["PRCRIN_10MIN"] = Constants.MISSING_INT16
-            point_dict["PRCRIN_10MIN_AQC"] = Constants.MISSING_INT8
-            point_dict["PRCRIN_1HOUR"] = Constants.MISSING_INT16
-            point_dict["PRCRIN_1HOUR_AQC"] = Constants.MISSING_INT8
-            point_dict["PRCRIN_24HOUR"] = Constants.MISSING_INT16
-            point_dict["PRCRIN_24HOUR_AQC"] = Constants.MISSING_INT8
-
-            precip_data = []
-            
-            def find_precipitation_data(node, precip_data):
-                """Find and categorize precipitation data by time period"""
-                if isinstance(node, list):
-                    time_period = None
-                    time_unit = None
-                    has_time_increment = False
-                    has_replication_factor = False
-                    precipitation_values = []
-                    
-                    for item in node:
-                        if isinstance(item, dict) and item.get("key") == "timePeriod":
-                            time_period = item.get("value")
-                            time_unit = item.get("units")
-                    
-                    if time_period == -10 and time_unit == "min":
-                        for item in node:
-                            if isinstance(item, dict) and item.get("key") == "totalPrecipitationOrTotalWaterEquivalent":
-                                precip_data.append({"type": "10min_direct", "value": item.get("value")})
-                    elif (time_period == -60 and time_unit == "min") or (time_period == -1 and time_unit == "h"):
-                        for item in node:
-                            if isinstance(item, dict) and item.get("key") == "totalPrecipitationOrTotalWaterEquivalent":
-                                precip_data.append({"type": "1hour", "value": item.get("value")})
-
-                    elif (time_period == -360 and time_unit == "min") or (time_period == -6 and time_unit == "h"): 
-                        for item in node:  
-                            if isinstance(item, dict) and item.get("key") == "totalPrecipitationOrTotalWaterEquivalent": 
-                                precip_data.append({"type": "6hour", "value": item.get("value")})  
-
-                    elif (time_period == -720 and time_unit == "min") or (time_period == -12 and time_unit == "h"):
-                        for item in node:  
-                            if isinstance(item, dict) and item.get("key") == "totalPrecipitationOrTotalWaterEquivalent":  
-                                precip_data.append({"type": "12hour", "value": item.get("value")}) 
-
-                    elif (time_period == -24 and time_unit == "h") or (time_period == -1440 and time_unit == "min"):
-                        for item in node:
-                            if isinstance(item, dict) and item.get("key") == "totalPrecipitationOrTotalWaterEquivalent":
-                                precip_data.append({"type": "24hour", "value": item.get("value")})
-                    elif time_period is not None and time_unit in ("min", "h") and time_period not in (-10, -60, -1, -6, -360, -12, -720, -24, -1440):
-
-                        for item in node:
-                            if isinstance(item, dict) and item.get("key") == "totalPrecipitationOrTotalWaterEquivalent":
-                                other_period = f"{time_period} {time_unit}"
-                                print(f"[WARNING] Found precipitation data with non-standard time period: {other_period}")
-                                precip_data.append({"type": "other_period", "value": item.get("value"), "period": other_period})
-                    elif time_period == -1 and time_unit == "min":
-                        for item in node:
-                            if isinstance(item, list):
-                                increment_val = None
-                                replication_val = None
-                                local_precip_values = []
-                                
-                                for subitem in item:
-                                    if isinstance(subitem, dict):
-                                        if subitem.get("key") == "timeIncrement":
-                                            increment_val = subitem.get("value")
-                                        elif subitem.get("key") == "delayedDescriptorReplicationFactor":
-                                            replication_val = subitem.get("value")
-                                        elif subitem.get("key") == "totalPrecipitationOrTotalWaterEquivalent":
-                                            local_precip_values.append(subitem.get("value"))
-                                
-                                if increment_val == 1 and replication_val == 10 and len(local_precip_values) == 10:
-                                    total_value = sum(float(val) for val in local_precip_values if val is not None)
-                                    precip_data.append({"type": "1min_aggregated", "value": total_value})
-                    
-                    for item in node:
-                        find_precipitation_data(item, precip_data)
-                elif isinstance(node, dict):
-                    for value in node.values():
-                        if isinstance(value, (list, dict)):
-                            find_precipitation_data(value, precip_data)
-
-            find_precipitation_data(subset, precip_data)
-
-            point_dict["PRCRIN_10MIN"] = Constants.MISSING_INT16
-            point_dict["PRCRIN_10MIN_AQC"] = Constants.MISSING_INT8
-            point_dict["PRCRIN_1HOUR"] = Constants.MISSING_INT16
-            point_dict["PRCRIN_1HOUR_AQC"] = Constants.MISSING_INT8
-            point_dict["PRCRIN_6HOUR"] = Constants.MISSING_INT16
-            point_dict["PRCRIN_6HOUR_AQC"] = Constants.MISSING_INT8
-            point_dict["PRCRIN_12HOUR"] = Constants.MISSING_INT16  
-            point_dict["PRCRIN_12HOUR_AQC"] = Constants.MISSING_INT8  
-            point_dict["PRCRIN_24HOUR"] = Constants.MISSING_INT16
-            point_dict["PRCRIN_24HOUR_AQC"] = Constants.MISSING_INT8
-            for data in precip_data:
-                if data["value"] is not None:
-                    try:
-                        if data["type"] in ("10min_direct", "1min_aggregated"):
-                            point_dict["PRCRIN_10MIN"] = int(float(data["value"]))
-                        elif data["type"] == "1hour":
-                            point_dict["PRCRIN_1HOUR"] = int(float(data["value"]))
-                        elif data["type"] == "6hour":  
-                            point_dict["PRCRIN_6HOUR"] = int(float(data["value"]))  
-                        elif data["type"] == "12hour":  
-                            point_dict["PRCRIN_12HOUR"] = int(float(data["value"])) 
-                        elif data["type"] == "24hour":
-                            point_dict["PRCRIN_24HOUR"] = int(float(data["value"]))
-                        elif data["type"] == "other_period":
-                            print(f"[WARNING] Station {station_name}: Using INVALID_INT16 for precipitation with period {data['period']}")
-                            point_dict["PRCRIN_10MIN"] = Constants.INVALID_INT16
-                            point_dict["PRCRIN_1HOUR"] = Constants.INVALID_INT16
-                            point_dict["PRCRIN_24HOUR"] = Constants.INVALID_INT16
-                    except (ValueError, TypeError):
-                        pass  
-
-            point_dict["SNWDPT"] = Constants.MISSING_INT16
-            point_dict["SNWDPT_AQC"] = Constants.MISSING_INT8
-
-            snow_depth_str = find_value_in_nested_list(subset, "totalSnowDepth")
-            point_dict["SNWDPT"] = convert_m_to_cm(snow_depth_str)
-            point_dict["SNWDPT_AQC"] = Constants.MISSING_INT8
-
-            cloud_str = find_value_in_nested_list(subset, "cloudCoverTotal")
-            if cloud_str is not None:
-                try:
-                    point_dict["AMTCLD"] = int(float(cloud_str))
-                except ValueError:
-                    point_dict["AMTCLD"] = Constants.MISSING_INT16
-            else:
-                point_dict["AMTCLD"] = Constants.MISSING_INT16
-            point_dict["AMTCLD_AQC"] = Constants.MISSING_INT8
-
-            hvis_str = find_value_in_nested_list(subset, "horizontalVisibility")
-            if hvis_str in [None, "", "--", "-"]:
-                point_dict["HVIS"] = Constants.MISSING_INT32
-            else:
-                point_dict["HVIS"] = convert_to_int_with_factor(hvis_str, factor=1)
-            point_dict["HVIS_AQC"] = Constants.MISSING_INT8
-
-            gust_dir_str = find_value_in_nested_list(subset, "maximumWindGustDirection")
-            point_dict["GUSTD"] = convert_to_int_with_factor(gust_dir_str, factor=1)
-            point_dict["GUSTD_AQC"] = Constants.MISSING_INT8
-
-            gust_speed_str = find_value_in_nested_list(subset, "maximumWindGustSpeed")
-            if gust_speed_str is not None:
-                try:
-                    point_dict["GUSTS"] = int(float(gust_speed_str) * 10)
-                except ValueError:
-                    point_dict["GUSTS"] = Constants.MISSING_INT16
-            else:
-                point_dict["GUSTS"] = Constants.MISSING_INT16
-            point_dict["GUSTS_AQC"] = Constants.MISSING_INT8
-
-            w10m_str = find_value_in_nested_list(subset, "maximumWindSpeed10MinuteMeanWind")
-            point_dict["WNDSPD_10MIN_AVG"] = convert_to_int_with_factor(w10m_str, factor=10)
-            point_dict["WNDSPD_10MIN_AVG_AQC"] = Constants.MISSING_INT8
-
-            mini_tmp_str = find_value_in_nested_list(subset, "minimumTemperatureAt2M")
-            point_dict["AIRTMP_1HOUR_MINI"] = convert_kelvin_to_tenths_celsius(mini_tmp_str)
-            point_dict["AIRTMP_1HOUR_MINI_AQC"] = Constants.MISSING_INT8
-
-            max_tmp_str = find_value_in_nested_list(subset, "maximumTemperatureAt2M")
-            point_dict["AIRTMP_1HOUR_MAX"] = convert_kelvin_to_tenths_celsius(max_tmp_str)
-            point_dict["AIRTMP_1HOUR_MAX_AQC"] = Constants.MISSING_INT8
-
-            dew_str = find_value_in_nested_list(subset, "dewpointTemperature")
-            point_dict["DEWTMP"] = convert_kelvin_to_tenths_celsius(dew_str)
-            point_dict["DEWTMP_AQC"] = Constants.MISSING_INT8
-
-            rhum_str = find_value_in_nested_list(subset, "relativeHumidity")
-            if rhum_str is not None:
-                try:
-                    point_dict["RHUM"] = int(float(rhum_str) * 10)
-                except ValueError:
-                    point_dict["RHUM"] = Constants.MISSING_INT16
-            else:
-                point_dict["RHUM"] = Constants.MISSING_INT16
-            point_dict["RHUM_AQC"] = Constants.MISSING_INT8
-
-            press_str = find_value_in_nested_list(subset, "nonCoordinatePressure")
-            if press_str is not None:
-                try:
-                    point_dict["ARPRSS"] = int(float(press_str) / 100.0 * 10)
-                except ValueError:
-                    point_dict["ARPRSS"] = Constants.MISSING_INT16
-            else:
-                point_dict["ARPRSS"] = Constants.MISSING_INT16
-            point_dict["ARPRSS_AQC"] = Constants.MISSING_INT8
-
-            mslp_str = find_value_in_nested_list(subset, "pressureReducedToMeanSeaLevel")
-            if mslp_str is not None:
-                try:
-                    point_dict["SSPRSS"] = int(float(mslp_str) / 100.0 * 10)
-                except ValueError:
-                    point_dict["SSPRSS"] = Constants.MISSING_INT16
-            else:
-                point_dict["SSPRSS"] = Constants.MISSING_INT16
-            point_dict["SSPRSS_AQC"] = Constants.MISSING_INT8
-
-            windspd_str = find_value_in_nested_list(subset, "windSpeed")
-            if windspd_str is not None:
-                try:
-                    point_dict["WNDSPD"] = int(float(windspd_str) * 10)
-                except ValueError:
-                    point_dict["WNDSPD"] = Constants.MISSING_INT16
-            else:
-                point_dict["WNDSPD"] = Constants.MISSING_INT16
-            point_dict["WNDSPD_AQC"] = Constants.MISSING_INT8
-
-            rad_str = find_value_in_nested_list(subset, "globalSolarRadiationIntegratedOverPeriodSpecified")
-            if rad_str is not None:
-                try:
-                    point_dict["GLBRAD_1HOUR"] = int(float(rad_str))
-                except ValueError:
-                    point_dict["GLBRAD_1HOUR"] = Constants.MISSING_INT16
-            else:
-                point_dict["GLBRAD_1HOUR"] = Constants.MISSING_INT16
-            point_dict["GLBRAD_1HOUR_AQC"] = Constants.MISSING_INT8
-
-            wx_str = find_value_in_nested_list(subset, "presentWeather")
-            code = convert_to_int(wx_str, missing=Constants.MISSING_INT16)
-            if code == Constants.MISSING_INT16 or code not in weather_mapping:
-                weather_str = ""
-            else:
-                weather_str = weather_mapping.get(code, "")
-            point_dict["WX_original"] = weather_str
-            point_dict["WX_original_AQC"] = Constants.MISSING_INT8
-
-            unique_records[station_name] = {"timestamp": timestamp_str, "data": point_dict}
+    precip_counts = new_precip_counts()
+    with_stations = latest_stations is not None
+
+    def merge(candidates, stations):
+        for station_name, geometry in stations:
+            latest_stations[station_name] = geometry
+        merge_candidates(unique_records, candidates)
+
+    if workers > 1:
+        pool = ConvertProcessPool(workers, weather_mapping, watermarks, incremental, with_stations)
+        try:
+            for candidates, stations, counts in pool.map(messages):
+                for key, count in counts.items():
+                    precip_counts[key] += count
+                merge(candidates, stations)
+        finally:
+            pool.close()
+    else:
+        latest_times = {}
+        for message in messages:
+            candidates, stations = convert_message(
+                message, weather_mapping, latest_times, precip_counts, watermarks, incremental, with_stations
+            )
+            merge(candidates, stations)
 
     point_data_list = [record["data"] for record in unique_records.values()]
     point_count = len(point_data_list)
+    if watermarks is not None:
+        # 古い電文や再送を処理してもハイウォーターマークは戻さない
+        for station_name, record in unique_records.items():
+            if record["timestamp"] > watermarks.get(station_name, ""):
+                watermarks[station_name] = record["timestamp"]
 
     now_utc = datetime.now(timezone.utc).replace(second=0, microsecond=0)
     announced_str = now_utc.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -647,16 +842,337 @@ def process_structured_json(bufr_data, tagid):
             }
         }
     
-    precip_counts = count_precipitation_data(bufr_data)
-    print(f"[PRECIP LOG] 10分間降水量(直接): {precip_counts['direct_10min_count']}件")
-    print(f"[PRECIP LOG] 1分値*10データから合計した10分間降水量: {precip_counts['one_min_aggregated_count']}件")
-    print(f"[PRECIP LOG] 1時間降水量: {precip_counts['one_hour_count']}件")
-    print(f"[PRECIP LOG] 6時間降水量: {precip_counts['six_hour_count']}件")
-    print(f"[PRECIP LOG] 12時間降水量: {precip_counts['twelve_hour_count']}件") 
-    print(f"[PRECIP LOG] 24時間降水量: {precip_counts['twenty_four_hour_count']}件")
-    print(f"[PRECIP LOG] その他の時間降水量: {precip_counts['other_time_period_count']}件")
+    emit_precipitation_metrics(precip_counts, tagid)
     return final_json
 
+class S3StreamingWriter:
+    """Upload bytes to S3 in multipart parts while they are still being produced.
+
+    Output smaller than one part is sent with a single put_object on close.
+    Only one part is uploaded in the background at a time, so memory stays
+    around two parts.
+    """
+
+    def __init__(self, client, bucket, key, content_type, part_size=RAW_UPLOAD_PART_SIZE):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.pending = None
+        self.executor = None
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def _upload_part(self, body):
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                ContentType=self.content_type
+            )
+            self.upload_id = response["UploadId"]
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        self._wait_pending()
+        part_number = len(self.parts) + 1
+        self.pending = (part_number, self.executor.submit(
+            self.client.upload_part,
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body
+        ))
+
+    def _wait_pending(self):
+        if self.pending:
+            part_number, future = self.pending
+            self.pending = None
+            self.parts.append({"PartNumber": part_number, "ETag": future.result()["ETag"]})
+
+    def close(self):
+        if self.upload_id is None:
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self.buffer),
+                ContentType=self.content_type
+            )
+            return
+        if self.buffer:
+            self._upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        self._wait_pending()
+        self.executor.shutdown()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts}
+        )
+
+    def abort(self):
+        if self.upload_id is None:
+            return
+        self.executor.shutdown(wait=True)
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print(f"Warning: Could not abort multipart upload for {self.key}: {str(e)}")
+
+def iter_bz2_text(stream, raw_writer=None, read_size=STREAM_READ_SIZE):
+    """Decompress a bz2 stream incrementally and yield the decoded text chunks
+
+    The decompressed bytes are also passed to raw_writer when one is given.
+    Concatenated bz2 streams are handled like bz2.decompress does.
+    """
+    decompressor = bz2.BZ2Decompressor()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    started = False
+    streams = 0
+    while True:
+        block = stream.read(read_size)
+        if not block:
+            break
+        while block:
+            try:
+                data = decompressor.decompress(block)
+            except OSError:
+                # 2つ目以降のストリームの後ろにあるゴミは bz2.decompress と同様に無視する
+                if streams and not started:
+                    return
+                raise
+            started = True
+            block = b""
+            if decompressor.eof:
+                streams += 1
+                block = decompressor.unused_data
+                decompressor = bz2.BZ2Decompressor()
+                started = False
+            if data:
+                if raw_writer is not None:
+                    raw_writer.write(data)
+                text = text_decoder.decode(data)
+                if text:
+                    yield text
+    if started or not streams:
+        raise ValueError("Compressed data ended before the end-of-stream marker was reached")
+    text = text_decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+def iter_bufr_messages(text_chunks):
+    """Yield the elements of the top-level "messages" array one at a time
+
+    Only the message being decoded is held in memory. When a message is not
+    complete yet, at least as much text again is read before the next attempt,
+    so each message is parsed a bounded number of times.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(text_chunks)
+    buffer = ""
+    pos = 0
+
+    def read_more(min_length=0):
+        nonlocal buffer, pos
+        pieces = [buffer[pos:]]
+        start_length = length = len(pieces[0])
+        target = max(min_length, start_length + 1)
+        for chunk in chunks:
+            pieces.append(chunk)
+            length += len(chunk)
+            if length >= target:
+                break
+        buffer = "".join(pieces)
+        pos = 0
+        return length > start_length
+
+    match = MESSAGES_ARRAY_PATTERN.search(buffer)
+    while match is None:
+        if not read_more():
+            raise ValueError("BUFR JSON does not contain a messages array")
+        match = MESSAGES_ARRAY_PATTERN.search(buffer)
+    pos = match.end()
+
+    while True:
+        pos = JSON_WHITESPACE_PATTERN.match(buffer, pos).end()
+        if pos >= len(buffer):
+            if not read_more():
+                raise ValueError("BUFR JSON ended inside the messages array")
+            continue
+        char = buffer[pos]
+        if char == "]":
+            break
+        if char == ",":
+            pos += 1
+            continue
+        try:
+            message, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            message, end = None, len(buffer)
+        # 途中で切れた値は次のチャンクを読んでから解析し直す
+        if end >= len(buffer) and read_more(2 * (len(buffer) - pos)):
+            continue
+        if message is None:
+            raise ValueError("BUFR JSON ended inside a message")
+        pos = end
+        yield message
+
+    # 残りを読み切って生データのアップロードを完了させる
+    for _ in chunks:
+        pass
+
+def generate_source_state_key(tagid):
+    return f"{tagid}/state/source_state.json"
+
+def load_source_state(raw_bucket, tagid):
+    """Load the validators and fingerprint of the last processed bundle"""
+    key = generate_source_state_key(tagid)
+    try:
+        response = s3_client_eu.get_object(Bucket=raw_bucket, Key=key)
+        return json.loads(response["Body"].read())
+    except s3_client_eu.exceptions.NoSuchKey:
+        return {}
+    except Exception as e:
+        print(f"Warning: Could not load source state from s3://{raw_bucket}/{key}: {str(e)}")
+        return {}
+
+def save_source_state(raw_bucket, tagid, state):
+    key = generate_source_state_key(tagid)
+    s3_client_eu.put_object(
+        Bucket=raw_bucket,
+        Key=key,
+        Body=json.dumps(state).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+def fetch_source(base_url, state):
+    """Download the bz2 bundle unless it is unchanged since state
+
+    Returns (compressed_data, new_state). compressed_data is None when the
+    server answers 304 or the content fingerprint matches state["sha256"].
+    """
+    headers = {}
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+
+    print(f"Downloading data from: {base_url}")
+    try:
+        with urllib.request.urlopen(urllib.request.Request(base_url, headers=headers)) as response:
+            if response.status != 200:
+                raise RuntimeError(f"Failed to download file. status code={response.status}")
+            compressed_data = response.read()
+            new_state = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")
+            }
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            print("Source not modified (HTTP 304)")
+            return None, state
+        raise RuntimeError(f"Failed to download file. status code={e.code}")
+
+    new_state["sha256"] = hashlib.sha256(compressed_data).hexdigest()
+    if new_state["sha256"] == state.get("sha256"):
+        print("Source content unchanged (same fingerprint)")
+        return None, new_state
+    return compressed_data, new_state
+
+def convert_bundle(compressed_data, raw_bucket, raw_key, tagid, with_stations=False, watermarks=None, incremental=False):
+    """Decompress the bundle as a stream: upload the raw JSON and convert each message as it is decoded"""
+    raw_writer = S3StreamingWriter(s3_client_eu, raw_bucket, raw_key, 'application/json')
+    latest_stations = {} if with_stations else None
+    try:
+        print("Decompressing bz2 data as a stream...")
+        messages = iter_bufr_messages(iter_bz2_text(io.BytesIO(compressed_data), raw_writer))
+        structured_json = convert_messages(messages, tagid, latest_stations, watermarks, incremental)
+        raw_writer.close()
+    except Exception:
+        raw_writer.abort()
+        raise
+    print(f"Raw data saved to s3://{raw_bucket}/{raw_key}")
+
+    geojson_data = build_station_geojson(latest_stations) if with_stations else None
+    return structured_json, geojson_data
+
+def generate_watermark_key(tagid):
+    return f"{tagid}/state/station_watermarks.json"
+
+def load_station_watermarks(raw_bucket, tagid):
+    """Load the last published observation time of each station"""
+    key = generate_watermark_key(tagid)
+    try:
+        response = s3_client_eu.get_object(Bucket=raw_bucket, Key=key)
+        return json.loads(response["Body"].read())
+    except s3_client_eu.exceptions.NoSuchKey:
+        return {}
+    except Exception as e:
+        print(f"Warning: Could not load station watermarks from s3://{raw_bucket}/{key}: {str(e)}")
+        return {}
+
+def save_station_watermarks(raw_bucket, tagid, watermarks):
+    s3_client_eu.put_object(
+        Bucket=raw_bucket,
+        Key=generate_watermark_key(tagid),
+        Body=json.dumps(watermarks, ensure_ascii=False).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+def publish_observations(structured_json, converted_bucket, tagid, now, incremental):
+    """Save the structured JSON; in incremental mode nothing is saved when no station has a new observation"""
+    if incremental and not structured_json["original"]["point_count"]:
+        print("No new observations since the last published run")
+        return None
+    return save_structured_json(structured_json, converted_bucket, tagid, now)
+
+def check_source(raw_bucket, tagid, base_url, with_stations=False):
+    """Fetch the bundle and decide whether it needs processing
+
+    Returns (compressed_data, source_state, previous_state); compressed_data
+    is None when nothing has to be published. A station run only skips when
+    the station GeoJSON was already published for the current bundle.
+    """
+    previous_state = load_source_state(raw_bucket, tagid)
+    state = previous_state
+    if with_stations and previous_state.get("stations_sha256") != previous_state.get("sha256"):
+        state = {}
+    compressed_data, source_state = fetch_source(base_url, state)
+    if compressed_data is None and source_state != previous_state:
+        source_state = dict(previous_state, **source_state)
+        save_source_state(raw_bucket, tagid, source_state)
+    return compressed_data, source_state, previous_state
+
+def unchanged_response(message):
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": message,
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        })
+    }
+
+def save_structured_json(structured_json, converted_bucket, tagid, now):
+    structured_json_str = json.dumps(structured_json, ensure_ascii=False, indent=2)
+    obs_filename = f"{now.strftime('%Y%m%d%H%M%S')}.{str(uuid.uuid4())}"
+    structured_key = f"data/{tagid}/{now.strftime('%Y/%m/%d')}/{obs_filename}"
+    s3_client_jp.put_object(
+        Bucket=converted_bucket,
+        Key=structured_key,
+        Body=structured_json_str.encode('utf-8'),
+        ContentType='application/json'
+    )
+    print(f"Structured JSON saved to s3://{converted_bucket}/{structured_key}")
+    return structured_key
+
 def process_full_data():
     try:
         validate_env_vars()
@@ -665,40 +1181,21 @@ def process_full_data():
         tagid = os.getenv("tagid")
         base_url = os.getenv("URL")
 
-        print(f"Downloading data from: {base_url}")
-        with urllib.request.urlopen(base_url) as response:
-            if response.status != 200:
-                raise RuntimeError(f"Failed to download file. status code={response.status}")
-            compressed_data = response.read()
-
-        print("Decompressing bz2 data in memory...")
-        decompressed_data = bz2.decompress(compressed_data)
+        compressed_data, source_state, _ = check_source(raw_bucket, tagid, base_url, with_stations=True)
+        if compressed_data is None:
+            return unchanged_response("Source data unchanged; nothing to publish")
 
+        incremental = os.getenv("PublishMode", "full") == "incremental"
+        watermarks = load_station_watermarks(raw_bucket, tagid)
         now = datetime.now(timezone.utc)
         raw_key = f"{tagid}/{now.strftime('%Y/%m/%d')}/{now.strftime('%Y%m%d%H%M%S')}_raw.json"
-        s3_client_eu.put_object(
-            Bucket=raw_bucket,
-            Key=raw_key,
-            Body=decompressed_data,
-            ContentType='application/json'
+        structured_json, geojson_data = convert_bundle(
+            compressed_data, raw_bucket, raw_key, tagid,
+            with_stations=True, watermarks=watermarks, incremental=incremental
         )
-        print(f"Raw data saved to s3://{raw_bucket}/{raw_key}")
 
-        bufr_data = json.loads(decompressed_data.decode('utf-8'))
+        structured_key = publish_observations(structured_json, converted_bucket, tagid, now, incremental)
 
-        structured_json = process_structured_json(bufr_data, tagid)
-        structured_json_str = json.dumps(structured_json, ensure_ascii=False, indent=2)
-        obs_filename = f"{now.strftime('%Y%m%d%H%M%S')}.{str(uuid.uuid4())}"
-        structured_key = f"data/{tagid}/{now.strftime('%Y/%m/%d')}/{obs_filename}"
-        s3_client_jp.put_object(
-            Bucket=converted_bucket,
-            Key=structured_key,
-            Body=structured_json_str.encode('utf-8'),
-            ContentType='application/json'
-        )
-        print(f"Structured JSON saved to s3://{converted_bucket}/{structured_key}")
-
-        geojson_data = create_geojson_from_raw_data(bufr_data)
         geojson_str = json.dumps(geojson_data, ensure_ascii=False, indent=2)
         geojson_key = "metadata/spool/DWD_SYNOP/metadata.json"
         s3_client_jp.put_object(
@@ -709,13 +1206,19 @@ def process_full_data():
         )
         print(f"GeoJSON saved to s3://{converted_bucket}/{geojson_key}")
 
+        save_station_watermarks(raw_bucket, tagid, watermarks)
+        source_state["stations_sha256"] = source_state["sha256"]
+        save_source_state(raw_bucket, tagid, source_state)
+
         return {
             "statusCode": 200,
             "body": json.dumps({
                 "message": "Data processed successfully",
                 "raw_data_location": f"s3://{raw_bucket}/{raw_key}",
-                "structured_json_location": f"s3://{converted_bucket}/{structured_key}",
-                "geojson_location": f"s3://{converted_bucket}/{geojson_key}"
+                "structured_json_location": f"s3://{converted_bucket}/{structured_key}" if structured_key else None,
+                "geojson_location": f"s3://{converted_bucket}/{geojson_key}",
+                "publish_mode": "incremental" if incremental else "full",
+                "point_count": structured_json["original"]["point_count"]
             })
         }
     except Exception as e:
@@ -737,45 +1240,33 @@ def process_observation_data():
         tagid = os.getenv("tagid")
         base_url = os.getenv("URL")
 
-        print(f"Downloading data from: {base_url}")
-        with urllib.request.urlopen(base_url) as response:
-            if response.status != 200:
-                raise RuntimeError(f"Failed to download file. status code={response.status}")
-            compressed_data = response.read()
-
-        print("Decompressing bz2 data in memory...")
-        decompressed_data = bz2.decompress(compressed_data)
+        compressed_data, source_state, previous_state = check_source(raw_bucket, tagid, base_url)
+        if compressed_data is None:
+            return unchanged_response("Source data unchanged; nothing to publish")
 
+        incremental = os.getenv("PublishMode", "full") == "incremental"
+        watermarks = load_station_watermarks(raw_bucket, tagid)
         now = datetime.now(timezone.utc)
         raw_key = f"{tagid}/{now.strftime('%Y/%m/%d')}/{now.strftime('%Y%m%d%H%M%S')}_raw.json"
-        s3_client_eu.put_object(
-            Bucket=raw_bucket,
-            Key=raw_key,
-            Body=decompressed_data,
-            ContentType='application/json'
+        structured_json, _ = convert_bundle(
+            compressed_data, raw_bucket, raw_key, tagid,
+            watermarks=watermarks, incremental=incremental
         )
-        print(f"Raw data saved to s3://{raw_bucket}/{raw_key}")
 
-        bufr_data = json.loads(decompressed_data.decode('utf-8'))
+        structured_key = publish_observations(structured_json, converted_bucket, tagid, now, incremental)
 
-        structured_json = process_structured_json(bufr_data, tagid)
-        structured_json_str = json.dumps(structured_json, ensure_ascii=False, indent=2)
-        obs_filename = f"{now.strftime('%Y%m%d%H%M%S')}.{str(uuid.uuid4())}"
-        structured_key = f"data/{tagid}/{now.strftime('%Y/%m/%d')}/{obs_filename}"
-        s3_client_jp.put_object(
-            Bucket=converted_bucket,
-            Key=structured_key,
-            Body=structured_json_str.encode('utf-8'),
-            ContentType='application/json'
-        )
-        print(f"Structured JSON saved to s3://{converted_bucket}/{structured_key}")
+        save_station_watermarks(raw_bucket, tagid, watermarks)
+        source_state["stations_sha256"] = previous_state.get("stations_sha256")
+        save_source_state(raw_bucket, tagid, source_state)
 
         return {
             "statusCode": 200,
             "body": json.dumps({
                 "message": "Observation data processed successfully",
                 "raw_data_location": f"s3://{raw_bucket}/{raw_key}",
-                "structured_json_location": f"s3://{converted_bucket}/{structured_key}"
+                "structured_json_location": f"s3://{converted_bucket}/{structured_key}" if structured_key else None,
+                "publish_mode": "incremental" if incremental else "full",
+                "point_count": structured_json["original"]["point_count"]
             })
         }
     except Exception as e:
@@ -824,15 +1315,6 @@ def process_json_data(json_file):
             print("Processing raw data format")
             tagid = "DWD_SYNOP" 
             
-            precip_counts = count_precipitation_data(data)
-            print(f"[PRECIP LOG] 10分間降水量(直接): {precip_counts['direct_10min_count']}件")
-            print(f"[PRECIP LOG] 1分値*10 個から合計した10分間降水量: {precip_counts['one_min_aggregated_count']}件")
-            print(f"[PRECIP LOG] 1時間降水量: {precip_counts['one_hour_count']}件")
-            print(f"[PRECIP LOG] 6時間降水量: {precip_counts['six_hour_count']}件")
-            print(f"[PRECIP LOG] 12時間降水量: {precip_counts['twelve_hour_count']}件")
-            print(f"[PRECIP LOG] 24時間降水量: {precip_counts['twenty_four_hour_count']}件")
-            print(f"[PRECIP LOG] その他の時間降水量: {precip_counts['other_time_period_count']}件")
-            
             structured_json = process_structured_json(data, tagid)
             data = structured_json
             
@@ -0,0 +1,298 @@
+"""Compare serial and multi-process conversion of a recorded DWD SYNOP bundle.
+
+Usage:
+    python benchmark.py <bundle.json.bz2> [workers ...] [--repeat N]
+    python benchmark.py <bundle.json.bz2> --classifier [--repeat N]
+    python benchmark.py --check [bundle.json.bz2]
+
+The bundle is the bz2 file downloaded from URL. Each mode converts the same
+bundle N times (default 3); the best time is reported and the output is
+checked to be identical to the serial conversion.
+
+With --classifier the per-list precipitation classification of every subset
+in the bundle is timed: the previous in-walk if/elif chain that collected
+typed entries for build_point_record (kept below as legacy_classify_precip)
+against SubsetIndex._classify_precip with PRECIP_PERIOD_TABLE. The list
+contexts are collected beforehand, so only the classification is timed, and
+the PRCRIN_* values and warnings are compared.
+
+With --check the 2 m air temperature chosen by SubsetIndex is compared with
+the previous recursive search (legacy_temperature_at_2m) on the built-in
+regression subsets and, when a bundle is given, on every subset in it.
+"""
+import os
+import io
+import sys
+import json
+import time
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app"))
+
+import main
+
+
+def convert(compressed_data, workers):
+    messages = main.iter_bufr_messages(main.iter_bz2_text(io.BytesIO(compressed_data)))
+    latest_stations = {}
+    with contextlib.redirect_stdout(io.StringIO()) as log:
+        structured_json = main.convert_messages(messages, "benchmark", latest_stations, workers=workers)
+    return {
+        "point_data": structured_json["original"]["point_data"],
+        "geojson": main.build_station_geojson(latest_stations),
+        "log": [line for line in log.getvalue().splitlines() if not line.startswith('{"_aws"')]
+    }
+
+
+PRECIP_FIELDS = ["PRCRIN_10MIN", "PRCRIN_1HOUR", "PRCRIN_6HOUR", "PRCRIN_12HOUR", "PRCRIN_24HOUR"]
+
+
+def precip_contexts(node, contexts):
+    """Collect (list, timePeriod, units, precipitation values) in the same order as SubsetIndex.walk"""
+    if isinstance(node, dict):
+        for value in node.values():
+            if isinstance(value, (list, dict)):
+                precip_contexts(value, contexts)
+    elif isinstance(node, list):
+        time_period = None
+        time_unit = None
+        precip_values = []
+        for item in node:
+            if isinstance(item, dict):
+                key = item.get("key")
+                if key == "timePeriod":
+                    time_period = item.get("value")
+                    time_unit = item.get("units")
+                elif key == "totalPrecipitationOrTotalWaterEquivalent":
+                    precip_values.append(item.get("value"))
+        contexts.append((node, time_period, time_unit, precip_values))
+        for item in node:
+            if isinstance(item, (list, dict)):
+                precip_contexts(item, contexts)
+    return contexts
+
+
+def legacy_classify_precip(contexts, station_name):
+    """Previous classifier: if/elif per list into typed entries, then dispatched to PRCRIN_* fields"""
+    precip_data = []
+    for node, time_period, time_unit, precip_values in contexts:
+        if time_period == -10 and time_unit == "min":
+            precip_data.extend({"type": "10min_direct", "value": value} for value in precip_values)
+        elif (time_period == -60 and time_unit == "min") or (time_period == -1 and time_unit == "h"):
+            precip_data.extend({"type": "1hour", "value": value} for value in precip_values)
+        elif (time_period == -360 and time_unit == "min") or (time_period == -6 and time_unit == "h"):
+            precip_data.extend({"type": "6hour", "value": value} for value in precip_values)
+        elif (time_period == -720 and time_unit == "min") or (time_period == -12 and time_unit == "h"):
+            precip_data.extend({"type": "12hour", "value": value} for value in precip_values)
+        elif (time_period == -24 and time_unit == "h") or (time_period == -1440 and time_unit == "min"):
+            precip_data.extend({"type": "24hour", "value": value} for value in precip_values)
+        elif time_period is not None and time_unit in ("min", "h") and time_period not in (-10, -60, -1, -6, -360, -12, -720, -24, -1440):
+            other_period = f"{time_period} {time_unit}"
+            precip_data.extend({"type": "other_period", "value": value, "period": other_period} for value in precip_values)
+        elif time_period == -1 and time_unit == "min":
+            for item in node:
+                if isinstance(item, list):
+                    increment_val = None
+                    replication_val = None
+                    local_precip_values = []
+                    for subitem in item:
+                        if isinstance(subitem, dict):
+                            if subitem.get("key") == "timeIncrement":
+                                increment_val = subitem.get("value")
+                            elif subitem.get("key") == "delayedDescriptorReplicationFactor":
+                                replication_val = subitem.get("value")
+                            elif subitem.get("key") == "totalPrecipitationOrTotalWaterEquivalent":
+                                local_precip_values.append(subitem.get("value"))
+                    if increment_val == 1 and replication_val == 10 and len(local_precip_values) == 10:
+                        total_value = sum(float(val) for val in local_precip_values if val is not None)
+                        precip_data.append({"type": "1min_aggregated", "value": total_value})
+
+    warnings = []
+    for data in precip_data:
+        if data["type"] == "other_period":
+            warnings.append(f"[WARNING] Found precipitation data with non-standard time period: {data['period']}")
+
+    fields = {field: main.Constants.MISSING_INT16 for field in PRECIP_FIELDS}
+    for data in precip_data:
+        if data["value"] is not None:
+            try:
+                if data["type"] in ("10min_direct", "1min_aggregated"):
+                    fields["PRCRIN_10MIN"] = int(float(data["value"]))
+                elif data["type"] == "1hour":
+                    fields["PRCRIN_1HOUR"] = int(float(data["value"]))
+                elif data["type"] == "6hour":
+                    fields["PRCRIN_6HOUR"] = int(float(data["value"]))
+                elif data["type"] == "12hour":
+                    fields["PRCRIN_12HOUR"] = int(float(data["value"]))
+                elif data["type"] == "24hour":
+                    fields["PRCRIN_24HOUR"] = int(float(data["value"]))
+                elif data["type"] == "other_period":
+                    warnings.append(f"[WARNING] Station {station_name}: Using INVALID_INT16 for precipitation with period {data['period']}")
+                    fields["PRCRIN_10MIN"] = main.Constants.INVALID_INT16
+                    fields["PRCRIN_1HOUR"] = main.Constants.INVALID_INT16
+                    fields["PRCRIN_24HOUR"] = main.Constants.INVALID_INT16
+            except (ValueError, TypeError):
+                pass
+    return fields, warnings
+
+
+def current_classify_precip(contexts, station_name):
+    """Current classifier: PRECIP_PERIOD_TABLE lookup writing straight into the subset's fields"""
+    index = main.SubsetIndex()
+    for node, time_period, time_unit, precip_values in contexts:
+        if time_period is not None:
+            index._classify_precip(node, time_period, time_unit, precip_values)
+
+    warnings = [f"[WARNING] Found precipitation data with non-standard time period: {period}"
+                for period, _ in index.other_periods]
+    fields = {field: main.Constants.MISSING_INT16 for field in PRECIP_FIELDS}
+    fields.update(index.precip_fields)
+    warnings += [f"[WARNING] Station {station_name}: Using INVALID_INT16 for precipitation with period {period}"
+                 for period, has_value in index.other_periods if has_value]
+    return fields, warnings
+
+
+def benchmark_classifier(compressed_data, repeat):
+    subset_contexts = []
+    for message in main.iter_bufr_messages(main.iter_bz2_text(io.BytesIO(compressed_data))):
+        for subset in next((item for item in message if isinstance(item, list)), []):
+            subset_contexts.append(precip_contexts(subset, []))
+    list_count = sum(len(contexts) for contexts in subset_contexts)
+
+    results = {}
+    for name, classify in (("legacy", legacy_classify_precip), ("current", current_classify_precip)):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            output = [classify(contexts, "TEST") for contexts in subset_contexts]
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = (best, output)
+
+    legacy_time, expected = results["legacy"]
+    current_time, output = results["current"]
+    identical = output == expected
+    print(f"subsets: {len(subset_contexts)}, lists: {list_count}")
+    print(f"legacy  : {legacy_time:.3f}s")
+    print(f"current : {current_time:.3f}s (x{legacy_time / current_time:.2f}) identical={identical}")
+    return 0 if identical else 1
+
+
+def legacy_temperature_at_2m(node):
+    """Previous search: the first airTemperature after a 2 m sensor height, depth first"""
+    if isinstance(node, list):
+        has_2m_height = False
+        for item in node:
+            if isinstance(item, dict):
+                if item.get("key") == "heightOfSensorAboveLocalGroundOrDeckOfMarinePlatform" and item.get("value") == 2:
+                    has_2m_height = True
+                elif has_2m_height and item.get("key") == "airTemperature":
+                    return item.get("value")
+        for item in node:
+            result = legacy_temperature_at_2m(item)
+            if result is not None:
+                return result
+    elif isinstance(node, dict):
+        for value in node.values():
+            if isinstance(value, (list, dict)):
+                result = legacy_temperature_at_2m(value)
+                if result is not None:
+                    return result
+    return None
+
+
+def sensor_block(height, temperature):
+    return [
+        {"key": "heightOfSensorAboveLocalGroundOrDeckOfMarinePlatform", "value": height, "units": "m"},
+        {"key": "airTemperature", "value": temperature, "units": "K"}
+    ]
+
+
+REGRESSION_SUBSETS = {
+    # 2m の気温を持つリストが複数ある場合は最初のものを使う
+    "two 2 m temperature lists": [
+        {"key": "stationOrSiteName", "value": "TEST"},
+        sensor_block(2, 279.95),
+        sensor_block(2, 289.95)
+    ],
+    "first 2 m temperature missing": [
+        {"key": "stationOrSiteName", "value": "TEST"},
+        sensor_block(2, None) + [sensor_block(2, 269.95)],
+        sensor_block(2, 289.95)
+    ],
+    "nested 2 m temperature before sibling": [
+        {"key": "stationOrSiteName", "value": "TEST"},
+        [sensor_block(0.05, 270.0), sensor_block(2, 279.95)],
+        sensor_block(2, 289.95)
+    ]
+}
+
+
+def check_temperature(compressed_data=None):
+    cases = list(REGRESSION_SUBSETS.items())
+    if compressed_data is not None:
+        for message in main.iter_bufr_messages(main.iter_bz2_text(io.BytesIO(compressed_data))):
+            subsets = next((item for item in message if isinstance(item, list)), [])
+            cases.extend((f"bundle subset {len(cases)}", subset) for subset in subsets)
+
+    failures = 0
+    for name, subset in cases:
+        expected = legacy_temperature_at_2m(subset)
+        actual = main.SubsetIndex(subset).temperature_2m
+        if actual != expected:
+            failures += 1
+            print(f"{name}: expected {expected}, got {actual}")
+    print(f"2 m temperature: {len(cases) - failures}/{len(cases)} subsets identical")
+    return 1 if failures else 0
+
+
+def run(compressed_data, workers, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = convert(compressed_data, workers)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main_benchmark(argv):
+    repeat = 3
+    if "--repeat" in argv:
+        position = argv.index("--repeat")
+        repeat = int(argv[position + 1])
+        del argv[position:position + 2]
+    classifier = "--classifier" in argv
+    if classifier:
+        argv.remove("--classifier")
+    if "--check" in argv:
+        argv.remove("--check")
+        if not argv:
+            return check_temperature()
+        with open(argv[0], "rb") as f:
+            return check_temperature(f.read())
+    if not argv:
+        print(__doc__)
+        return 1
+
+    with open(argv[0], "rb") as f:
+        compressed_data = f.read()
+    if classifier:
+        return benchmark_classifier(compressed_data, repeat)
+    worker_counts = [int(value) for value in argv[1:]] or [os.cpu_count() or 2]
+
+    serial_time, expected = run(compressed_data, 1, repeat)
+    print(f"bundle: {argv[0]} ({len(compressed_data) / 1024 / 1024:.1f}MB), points: {len(expected['point_data'])}, cpus: {os.cpu_count()}")
+    print(f"serial      : {serial_time:.3f}s")
+    for workers in worker_counts:
+        elapsed, result = run(compressed_data, workers, repeat)
+        identical = json.dumps(result, ensure_ascii=False) == json.dumps(expected, ensure_ascii=False)
+        print(f"{workers:2d} workers  : {elapsed:.3f}s (x{serial_time / elapsed:.2f}) identical={identical}")
+        if not identical:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark(sys.argv[1:]))
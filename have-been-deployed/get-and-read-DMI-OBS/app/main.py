@@ -2,11 +2,16 @@ import os
 import json
 import urllib.request
 import urllib.error
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import boto3
 import uuid
-from time import sleep
+from time import sleep, monotonic
 import socket
+import threading
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 s3_client_eu = boto3.client("s3", region_name="eu-central-1")
 s3_client_jp = boto3.client("s3", region_name="ap-northeast-1")
@@ -35,6 +40,17 @@ MISSING_INT32 = MISSING_VALUES["INT32"]
 MISSING_INT16 = MISSING_VALUES["INT16"]
 MISSING_INT8 = MISSING_VALUES["INT8"]
 
+# ページ取得の並列数と、リクエスト開始間隔（秒）の下限。
+# 間隔は従来のページ間の待機（2秒）と同じにし、DMI API へのリクエスト頻度は増やさない
+FETCH_WORKERS = int(os.getenv("FetchWorkers", "4"))
+FETCH_INTERVAL = float(os.getenv("FetchInterval", "2"))
+FETCH_MAX_RETRIES = 3
+FETCH_TIMEOUT = 30
+RAW_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+# incremental で遅れて届く観測値も取得できるよう、最新の観測時刻からさかのぼって取得する時間
+INCREMENTAL_LOOKBACK = timedelta(minutes=30)
+PUBLISH_MODES = ("full", "incremental")
+
 def get_memory_cache(key):
     try:
         if key in memory_cache:
@@ -77,6 +93,9 @@ def validate_env_vars():
     missing_vars = [var for var in required_vars if not os.getenv(var)]
     if missing_vars:
         raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
+    publish_mode = os.getenv("PublishMode", "full")
+    if publish_mode not in PUBLISH_MODES:
+        raise ValueError(f"Invalid PublishMode: {publish_mode} (expected one of {', '.join(PUBLISH_MODES)})")
 
 def save_to_s3_raw(bucket, key, body):
     try:
@@ -104,6 +123,73 @@ def save_to_s3_converted(bucket, key, body):
     except Exception as error:
         raise ValueError(f"Failed to save converted data to JP S3: {str(error)}")
 
+class RawFeatureWriter:
+    """Spool the raw FeatureCollection page by page and upload it with its RU header.
+
+    The body is written to a temporary file in the same layout as
+    json.dumps(complete_dataset, indent=4), and the compact size used for the
+    header's data_size is counted as pages arrive, so memory stays bounded by
+    the page size.
+    """
+
+    def __init__(self):
+        self.spool = tempfile.TemporaryFile()
+        self.count = 0
+        self.compact_size = len(json.dumps({"type": "FeatureCollection", "features": []}))
+        self.spool.write(b'{\n    "type": "FeatureCollection",\n    "features": [')
+
+    def write_features(self, features):
+        for feature in features:
+            body = json.dumps(feature, indent=4, ensure_ascii=False).replace("\n", "\n        ")
+            separator = ",\n        " if self.count else "\n        "
+            self.spool.write((separator + body).encode('utf-8'))
+            self.compact_size += len(json.dumps(feature).encode('utf-8')) + (2 if self.count else 0)
+            self.count += 1
+
+    def upload(self, bucket, key, ruheader):
+        self.spool.write(b'\n    ]\n}' if self.count else b']\n}')
+        self.spool.seek(0)
+        first_part = ruheader.encode('utf-8') + self.spool.read(RAW_UPLOAD_PART_SIZE)
+        chunk = self.spool.read(RAW_UPLOAD_PART_SIZE)
+        if not chunk:
+            return save_to_s3_raw(bucket, key, first_part)
+
+        upload_id = None
+        try:
+            upload_id = s3_client_eu.create_multipart_upload(
+                Bucket=bucket,
+                Key=key,
+                ContentType='application/json'
+            )['UploadId']
+            parts = []
+            body = first_part
+            while body:
+                part_number = len(parts) + 1
+                response = s3_client_eu.upload_part(
+                    Body=body,
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number
+                )
+                parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+                body, chunk = chunk, self.spool.read(RAW_UPLOAD_PART_SIZE)
+            s3_client_eu.complete_multipart_upload(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+            print(f"Successfully saved raw data to EU S3: {bucket}/{key}")
+            return True
+        except Exception as error:
+            if upload_id:
+                s3_client_eu.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise ValueError(f"Failed to save raw data to EU S3: {str(error)}")
+
+    def close(self):
+        self.spool.close()
+
 def create_ruheader(announced, header_comment, dataname, dataid16, data_size=0, data_format="GeoJSON"):
     RU_HEADER_BEG_SIGNATURE = "WN\n"
     RU_HEADER_END_SIGNATURE = "\x04\x1a"
@@ -129,6 +215,61 @@ def generate_raw_s3_key(tagid, filename):
 def generate_json_s3_key(tagid, filename):
     return f"data/{tagid}/{datetime.now(timezone.utc).strftime('%Y/%m/%d')}/{filename}"
 
+def generate_watermark_key(tagid):
+    return f"{tagid}/state/observed_watermarks.json"
+
+def load_observed_watermarks(bucket, tagid):
+    """Load the last published observed time overall ("latest"), per station and parameter ("stations"),
+    and the converted value published for each of those ("values")"""
+    key = generate_watermark_key(tagid)
+    try:
+        response = s3_client_eu.get_object(Bucket=bucket, Key=key)
+        return json.loads(response["Body"].read())
+    except s3_client_eu.exceptions.NoSuchKey:
+        return {}
+    except Exception as e:
+        print(f"Warning: Could not load observed watermarks from s3://{bucket}/{key}: {str(e)}")
+        return {}
+
+def save_observed_watermarks(bucket, tagid, watermarks):
+    s3_client_eu.put_object(
+        Bucket=bucket,
+        Key=generate_watermark_key(tagid),
+        Body=json.dumps(watermarks, ensure_ascii=False).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+def update_observed_watermarks(watermarks, observed_times, station_data, latest_observed):
+    """Advance the watermarks with the observed times and values written to the station records"""
+    stations = watermarks.setdefault("stations", {})
+    values = watermarks.setdefault("values", {})
+    for station_id, parameter_times in observed_times.items():
+        station_marks = stations.setdefault(str(station_id), {})
+        station_values = values.setdefault(str(station_id), {})
+        for parameter_id, observed in parameter_times.items():
+            if observed > station_marks.get(parameter_id, ""):
+                station_marks[parameter_id] = observed
+                station_values[parameter_id] = station_data[station_id][PARAMETER_MAPPING[parameter_id][0]]
+    if latest_observed and latest_observed > watermarks.get("latest", ""):
+        watermarks["latest"] = latest_observed
+    return watermarks
+
+def carry_forward_values(station_id, data, watermarks, updated_parameters, cutoff):
+    """Fill the parameters not updated in this run with the last published values observed at or after cutoff
+
+    This gives an incremental station record the same values a latest-hour
+    (full) run would publish, instead of MISSING for every parameter that
+    has no newer observation.
+    """
+    station_marks = watermarks.get("stations", {}).get(str(station_id), {})
+    station_values = watermarks.get("values", {}).get(str(station_id), {})
+    for parameter_id, value in station_values.items():
+        if parameter_id in updated_parameters or station_marks.get(parameter_id, "") < cutoff:
+            continue
+        field_name = PARAMETER_MAPPING[parameter_id][0]
+        data[field_name] = value
+        data[f"{field_name}_AQC"] = -99
+
 def get_weather_description(ww_code):
     weather_codes = {
         0: "Cloud development not observed or not observable",
@@ -335,32 +476,34 @@ def map_cloud_cover(value):
     closest = min(cloud_cover_mapping.keys(), key=lambda x: abs(x - value))
     return cloud_cover_mapping[closest]
 
+# パラメータID → (JSON要素, 変換関数, 型)。モジュール読み込み時に1回だけ作成する
+PARAMETER_MAPPING = {
+    "temp_dry": ("AIRTMP", lambda x: int(x * 10), "INT16"),
+    "temp_max_past1h": ("AIRTMP_1HOUR_MAX", lambda x: int(x * 10), "INT16"),  
+    "temp_mean_past1h": ("AIRTMP_1HOUR_AVG", lambda x: int(x * 10), "INT16"),  
+    "temp_min_past1h": ("AIRTMP_1HOUR_MINI", lambda x: int(x * 10), "INT16"),  
+    "cloud_cover": ("AMTCLD_8", map_cloud_cover, "INT16"),  
+    "humidity": ("RHUM", lambda x: int(x * 10), "INT16"),
+    "precip_past10min": ("PRCRIN_10MIN", lambda x: int(x * 10), "INT16"),
+    "precip_past1h": ("PRCRIN_1HOUR", lambda x: int(x * 10), "INT16"),
+    "pressure": ("ARPRSS", lambda x: int(x * 10), "INT16"),
+    "pressure_at_sea": ("SSPRSS", lambda x: int(x * 10), "INT16"),  
+    "temp_dew": ("DEWTMP", lambda x: int(x * 10), "INT16"),
+    "visibility": ("HVIS", int, "INT32"),
+    "radia_glob": ("GLBRAD_10MIN", lambda x: int(x * 600 / 10000), "INT16"),  # W/m² → J/cm² (10 minutes)
+    "radia_glob_past1h": ("GLBRAD_1HOUR", lambda x: int(x * 3600 / 10000), "INT16"),  # W/m² → J/cm² (1 hour)
+    "sun_last10min_glob": ("SUNDUR_10MIN", int, "INT16"),  
+    "wind_dir": ("WNDDIR", int, "INT16"),  
+    "wind_max": ("WNDSPD_10MIN_MAX", lambda x: int(x * 10), "INT16"),  
+    "wind_max_per10min_past1h": ("WNDSPD_1HOUR_MAX", lambda x: int(x * 10), "INT16"),  
+    "wind_speed": ("WNDSPD", lambda x: int(x * 10), "INT16"),  
+    "weather": ("WX_original", get_weather_description, "STR")
+}
+
 def map_parameter_value(parameter_id, value):
-    parameter_mapping = {
-        "temp_dry": ("AIRTMP", lambda x: int(x * 10), "INT16"),
-        "temp_max_past1h": ("AIRTMP_1HOUR_MAX", lambda x: int(x * 10), "INT16"),  
-        "temp_mean_past1h": ("AIRTMP_1HOUR_AVG", lambda x: int(x * 10), "INT16"),  
-        "temp_min_past1h": ("AIRTMP_1HOUR_MINI", lambda x: int(x * 10), "INT16"),  
-        "cloud_cover": ("AMTCLD_8", lambda x: map_cloud_cover(x), "INT16"),  
-        "humidity": ("RHUM", lambda x: int(x * 10), "INT16"),
-        "precip_past10min": ("PRCRIN_10MIN", lambda x: int(x * 10), "INT16"),
-        "precip_past1h": ("PRCRIN_1HOUR", lambda x: int(x * 10), "INT16"),
-        "pressure": ("ARPRSS", lambda x: int(x * 10), "INT16"),
-        "pressure_at_sea": ("SSPRSS", lambda x: int(x * 10), "INT16"),  
-        "temp_dew": ("DEWTMP", lambda x: int(x * 10), "INT16"),
-        "visibility": ("HVIS", lambda x: int(x), "INT32"),
-        "radia_glob": ("GLBRAD_10MIN", lambda x: int(x * 600 / 10000), "INT16"),  # W/m² → J/cm² (10 minutes)
-        "radia_glob_past1h": ("GLBRAD_1HOUR", lambda x: int(x * 3600 / 10000), "INT16"),  # W/m² → J/cm² (1 hour)
-        "sun_last10min_glob": ("SUNDUR_10MIN", lambda x: int(x), "INT16"),  
-        "wind_dir": ("WNDDIR", lambda x: int(x), "INT16"),  
-        "wind_max": ("WNDSPD_10MIN_MAX", lambda x: int(x * 10), "INT16"),  
-        "wind_max_per10min_past1h": ("WNDSPD_1HOUR_MAX", lambda x: int(x * 10), "INT16"),  
-        "wind_speed": ("WNDSPD", lambda x: int(x * 10), "INT16"),  
-        "weather": ("WX_original", lambda x: get_weather_description(x), "STR")
-    }
-    
-    if parameter_id in parameter_mapping:
-        field_name, converter, value_type = parameter_mapping[parameter_id]
+    mapping = PARAMETER_MAPPING.get(parameter_id)
+    if mapping:
+        field_name, converter, value_type = mapping
         try:
             if value is None:
                 return field_name, get_missing_value(value_type)
@@ -454,117 +597,195 @@ def initialize_parameter_counts():
         "weather": 0
     }
 
-def fetch_all_data():
-
-    cache_key = f"api_data_{datetime.now(timezone.utc).strftime('%Y%m%d_%H')}"
-    
-    cached_data = get_memory_cache(cache_key)
-    if cached_data:
-        print("Using cached API data")
-        return cached_data
+class RequestRateLimiter:
+    """Space request starts at least `interval` seconds apart across threads."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        if start > now:
+            sleep(start - now)
+
+def build_request_url(params, **extra):
+    param_str = '&'.join(f"{key}={value}" for key, value in {**params, **extra}.items())
+    return f"{base_url}?{param_str}"
+
+def find_next_link(data):
+    for link in data.get('links', []):
+        if link['rel'] == 'next':
+            return link['href']
+    return None
 
+def fetch_page(request_url, rate_limiter, max_retries=FETCH_MAX_RETRIES, timeout=FETCH_TIMEOUT):
+    retry_count = 0
+    while retry_count < max_retries:
+        try:
+            rate_limiter.wait()
+            req = urllib.request.Request(request_url)
+            with urllib.request.urlopen(req, timeout=timeout) as response:
+                return json.loads(response.read().decode())
+        except urllib.error.HTTPError as e:
+            if e.code == 504: 
+                retry_count += 1
+                if retry_count < max_retries:
+                    print(f"Gateway timeout, retrying... (Attempt {retry_count + 1}/{max_retries})")
+                    sleep(retry_count * 5)  
+                    continue
+            print(f"HTTP Error: {e.code} - {e.reason}")
+            raise
+        except urllib.error.URLError as e:
+            print(f"URL Error: {e.reason}")
+            raise
+        except socket.timeout:
+            retry_count += 1
+            if retry_count < max_retries:
+                print(f"Request timed out, retrying... (Attempt {retry_count + 1}/{max_retries})")
+                sleep(retry_count * 5)
+                continue
+            raise urllib.error.URLError("Timeout after multiple retries")
+
+    raise Exception("Maximum retry attempts reached")
+
+def page_features(data):
+    if 'features' not in data:
+        print("Warning: No 'features' found in response")
+        return None
+    if not data['features']:
+        print("Warning: Empty features array received")
+        return None
+    return data['features']
+
+def fetch_pages_in_order(page_urls, rate_limiter, workers=FETCH_WORKERS):
+    """Fetch the pages concurrently and yield them in order, with at most 2 x workers pages in flight."""
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    urls = iter(page_urls)
+    try:
+        for url in urls:
+            pending.append(executor.submit(fetch_page, url, rate_limiter))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            data = pending.popleft().result()
+            url = next(urls, None)
+            if url:
+                pending.append(executor.submit(fetch_page, url, rate_limiter))
+            yield data
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def build_query_params(since=None):
+    """Query the latest hour, or only observations from INCREMENTAL_LOOKBACK before `since` when it lies within that hour
+
+    Stations report late and out of order, so the window reaches back before
+    the newest published observation; values already published are dropped
+    afterwards with the per-station watermarks.
+    """
     params = {
         "period": "latest-hour",
         "bbox-crs": "https://www.opengis.net/def/crs/OGC/1.3/CRS84",
         "api-key": os.getenv("APIKey")
     }
-
-    all_features = []
-    page_count = 1
-    current_url = base_url
+    if since:
+        since_dt = datetime.fromisoformat(since.replace('Z', '+00:00'))
+        if datetime.now(timezone.utc) - since_dt < timedelta(hours=1):
+            start = (since_dt - INCREMENTAL_LOOKBACK).strftime('%Y-%m-%dT%H:%M:%SZ')
+            params = {
+                "datetime": f"{start}/..",
+                "bbox-crs": params["bbox-crs"],
+                "api-key": params["api-key"]
+            }
+    return params
+
+def iter_observation_pages(params):
+    """Yield the features of each page of the query in page order."""
+    page_count = 0
+    record_count = 0
     total_pages = None
-    max_retries = 3 
-    timeout = 30     
+    rate_limiter = RequestRateLimiter(FETCH_INTERVAL)
 
     try:
-        while True:
-            
-            if page_count == 1:
-                param_str = '&'.join(f"{key}={value}" for key, value in params.items())
-                request_url = f"{current_url}?{param_str}"
-            else:
-                request_url = current_url
-
-            retry_count = 0
-            while retry_count < max_retries:
-                try:
-                    req = urllib.request.Request(request_url)
-                    with urllib.request.urlopen(req, timeout=timeout) as response:
-                        data = json.loads(response.read().decode())
-                    break  
-                except urllib.error.HTTPError as e:
-                    if e.code == 504: 
-                        retry_count += 1
-                        if retry_count < max_retries:
-                            print(f"Gateway timeout, retrying... (Attempt {retry_count + 1}/{max_retries})")
-                            sleep(retry_count * 5)  
-                            continue
-                    print(f"HTTP Error: {e.code} - {e.reason}")
-                    raise
-                except urllib.error.URLError as e:
-                    print(f"URL Error: {e.reason}")
-                    raise
-                except socket.timeout:
-                    retry_count += 1
-                    if retry_count < max_retries:
-                        print(f"Request timed out, retrying... (Attempt {retry_count + 1}/{max_retries})")
-                        sleep(retry_count * 5)
-                        continue
-                    raise urllib.error.URLError("Timeout after multiple retries")
-
-            if retry_count >= max_retries:
-                raise Exception("Maximum retry attempts reached")
-
-            if 'features' not in data:
-                print("Warning: No 'features' found in response")
-                break
-
-            features = data['features']
-            if not features:
-                print("Warning: Empty features array received")
-                break
-
-            all_features.extend(features)
-
-            if 'numberMatched' in data and page_count == 1:
+        data = fetch_page(build_request_url(params), rate_limiter)
+        features = page_features(data)
+        next_link = None
+        if features:
+            page_count = 1
+            record_count = len(features)
+            next_link = find_next_link(data)
+
+            if 'numberMatched' in data:
                 total_records = data['numberMatched']
                 records_per_page = len(features)
                 total_pages = -(-total_records // records_per_page)
                 print(f"Expected total pages: {total_pages}")
-
-            next_link = None
-            if 'links' in data:
-                for link in data['links']:
-                    if link['rel'] == 'next':
-                        next_link = link['href']
-                        break
-
-            if not next_link:
-                print("No more pages available")
+            yield features
+
+        # numberMatched から残りのページの offset を求めて並列に取得し、ページ順に返す
+        if next_link and total_pages and total_pages > 1:
+            page_urls = [
+                build_request_url(params, limit=records_per_page, offset=page * records_per_page)
+                for page in range(1, total_pages)
+            ]
+            for data in fetch_pages_in_order(page_urls, rate_limiter):
+                features = page_features(data)
+                if not features:
+                    next_link = None
+                    break
+                page_count += 1
+                record_count += len(features)
+                next_link = find_next_link(data)
+                yield features
+
+        # 取得中に件数が増えた場合などは、残りを next リンクで順に取得する
+        while next_link:
+            data = fetch_page(next_link, rate_limiter)
+            features = page_features(data)
+            if not features:
                 break
-
-            current_url = next_link
             page_count += 1
-            sleep(2)  
+            record_count += len(features)
+            next_link = find_next_link(data)
+            yield features
+
+        if page_count and not next_link:
+            print("No more pages available")
 
-        print(f"Completed fetching {page_count} pages with total {len(all_features)} records")
+        print(f"Completed fetching {page_count} pages with total {record_count} records")
         
         if total_pages and page_count != total_pages:
             print(f"Warning: Expected {total_pages} pages but got {page_count} pages")
 
-        result = (all_features, page_count)
-        if all_features:
-            set_memory_cache(cache_key, result)
-            print(f"API data cached with key: {cache_key}")
-
-        return result
-
     except Exception as e:
         print(f"Error fetching data: {e}")
         raise
 
 
-def process_feature(feature, station_data, parameter_counts):
+@lru_cache(maxsize=1024)
+def is_valid_observed(observed):
+    """Return True when `observed` parses as an ISO 8601 time; the same few times repeat across features"""
+    try:
+        datetime.fromisoformat(observed.replace('Z', '+00:00'))
+        return True
+    except (AttributeError, ValueError):
+        return False
+
+
+def process_feature(feature, station_data, parameter_counts, observed_times, watermarks=None):
+    """Fold one feature into station_data and return True when it updated a field
+
+    The observed time of each written value is kept in observed_times
+    (station -> parameter -> observed) rather than in the station record.
+    The API returns `observed` in the fixed "YYYY-MM-DDTHH:MM:SSZ" form, so
+    the times are compared as strings. With watermarks (same shape),
+    observations that are not newer than the last published one are skipped.
+    """
     props = feature["properties"]
     station_id = props["stationId"]
     parameter_id = props["parameterId"]
@@ -578,21 +799,21 @@ def process_feature(feature, station_data, parameter_counts):
         station_data[station_id] = initialize_station_data(station_id)
 
     if observed:
-        observed_dt = datetime.fromisoformat(observed.replace('Z', '+00:00'))
-        current_timestamp = station_data[station_id].get(f"{parameter_id}_timestamp")
-        if not current_timestamp or observed_dt > current_timestamp:
+        if watermarks and observed <= watermarks.get(str(station_id), {}).get(parameter_id, ""):
+            return False
+        parameter_times = observed_times.setdefault(station_id, {})
+        if observed > parameter_times.get(parameter_id, ""):
             field_name, converted_value = map_parameter_value(parameter_id, value)
             if field_name:
                 station_data[station_id][field_name] = converted_value
                 station_data[station_id][f"{field_name}_AQC"] = -99
-                station_data[station_id][f"{parameter_id}_timestamp"] = observed_dt
+                parameter_times[parameter_id] = observed
+                return True
+    return False
 
 
 def create_converted_json(station_data, observed_time):
-    cleaned_station_data = []
-    for station_id, data in station_data.items():
-        cleaned_data = {key: value for key, value in data.items() if not key.endswith("_timestamp")}
-        cleaned_station_data.append(cleaned_data)
+    point_data = list(station_data.values())
 
     return {
         "tagid": "441000125",
@@ -607,8 +828,8 @@ def create_converted_json(station_data, observed_time):
                 "min": observed_time.minute,
                 "sec": 0
             },
-            "point_count": len(cleaned_station_data),
-            "point_data": cleaned_station_data
+            "point_count": len(point_data),
+            "point_data": point_data
         }
     }
 
@@ -620,77 +841,124 @@ def process_and_save_data():
 
         current_time = datetime.now(timezone.utc)
         cache_key = f"processed_data_{current_time.strftime('%Y%m%d_%H')}"
+        incremental = os.getenv("PublishMode", "full") == "incremental"
 
-        cached_result = get_memory_cache(cache_key)
+        # incremental では毎回ハイウォーターマーク以降を取得するため、処理結果のキャッシュは使わない
+        cached_result = None if incremental else get_memory_cache(cache_key)
         if cached_result:
             print("Using cached processed data")
             return cached_result
 
-        print("Fetching data from API...")
-        all_features, page_count = fetch_all_data()
-
-        if not all_features:
-            raise ValueError("No features found in API response")
-
-        latest_observed = None
-        for feature in all_features:
-            observed = feature['properties'].get('observed')
-            if observed:
-                try:
-                    observed_dt = datetime.fromisoformat(observed.replace('Z', '+00:00'))
-                    if not latest_observed or observed_dt > latest_observed:
-                        latest_observed = observed_dt
-                except ValueError:
-                    continue
-
-        if not latest_observed:
-            latest_observed = datetime.now(timezone.utc)
-
-        complete_dataset = {
-            "type": "FeatureCollection",
-            "features": all_features
-        }
-
-        created = datetime.now(timezone.utc) 
-
-        dataname = "DMI_OBS_AWS_raw"
-        dataid16 = "0200600041000125"
-        data_size = len(json.dumps(complete_dataset).encode('utf-8'))
-        header_comment = base_url
-        ruheader = create_ruheader(created, header_comment, dataname, dataid16, data_size)
-
-        raw_json_data = json.dumps(complete_dataset, indent=4, ensure_ascii=False).encode('utf-8')
-        combined_data = ruheader.encode('utf-8') + raw_json_data
-
-        output_file_name = datetime.now(timezone.utc).strftime('%Y%m%d%H%M')
-        raw_s3_key = generate_raw_s3_key(tagid, output_file_name)
-
-        save_to_s3_raw(
-            raw_data_bucket,
-            raw_s3_key,
-            combined_data
-        )
+        watermarks = load_observed_watermarks(raw_data_bucket, tagid)
+        params = build_query_params(watermarks.get("latest") if incremental else None)
+        station_marks = watermarks.get("stations", {}) if incremental else None
+        if "datetime" in params:
+            print(f"Fetching observations since {params['datetime'][:-3]} (latest published {watermarks['latest']})")
 
         station_data = {}
+        observed_times = {}
+        changed_stations = set()
         parameter_counts = initialize_parameter_counts()
+        latest_observed = None
+        total_records = 0
+        invalid_observed = 0
+        raw_writer = RawFeatureWriter()
 
-        print("\nProcessing features...")
-        for feature in all_features:
-            process_feature(feature, station_data, parameter_counts)
+        try:
+            # ページが届くたびに生データの書き出しと観測所ごとの集約を行う
+            print("Fetching and processing data from API...")
+            for features in iter_observation_pages(params):
+                raw_writer.write_features(features)
+                for feature in features:
+                    observed = feature['properties'].get('observed')
+                    # 不正な観測時刻の値は文字列の比較に使わず読み飛ばす
+                    if observed and not is_valid_observed(observed):
+                        invalid_observed += 1
+                        continue
+                    if observed and (not latest_observed or observed > latest_observed):
+                        latest_observed = observed
+                    if process_feature(feature, station_data, parameter_counts, observed_times, station_marks):
+                        changed_stations.add(feature['properties']['stationId'])
+                total_records += len(features)
+            if invalid_observed:
+                print(f"Warning: Skipped {invalid_observed} records with an invalid observed time")
+
+            if not total_records:
+                if incremental and "datetime" in params:
+                    print("No new observations since the last published run")
+                    return {
+                        'statusCode': 200,
+                        'body': json.dumps({
+                            'message': 'No new observations',
+                            'statistics': {
+                                'total_records': 0,
+                                'total_stations': 0,
+                                'raw_data_location': None,
+                                'converted_data_location': None,
+                                'publish_mode': 'incremental',
+                                'parameter_counts': parameter_counts
+                            }
+                        })
+                    }
+                raise ValueError("No features found in API response")
+
+            observed_time = datetime.fromisoformat(latest_observed.replace('Z', '+00:00')) if latest_observed else datetime.now(timezone.utc)
+
+            created = datetime.now(timezone.utc) 
+
+            dataname = "DMI_OBS_AWS_raw"
+            dataid16 = "0200600041000125"
+            header_comment = base_url
+            ruheader = create_ruheader(created, header_comment, dataname, dataid16, raw_writer.compact_size)
+
+            output_file_name = datetime.now(timezone.utc).strftime('%Y%m%d%H%M')
+            raw_s3_key = generate_raw_s3_key(tagid, output_file_name)
+
+            raw_writer.upload(
+                raw_data_bucket,
+                raw_s3_key,
+                ruheader
+            )
+        finally:
+            raw_writer.close()
 
         print(f"Processed {len(station_data)} unique stations")
 
-        converted_result = create_converted_json(station_data, latest_observed)
-
-        current_time = datetime.now()
-        random_suffix = str(uuid.uuid4())
-        json_file_name = f"{current_time.strftime('%Y%m%d%H%M%S')}.{random_suffix}"
-        conv_s3_key = generate_json_s3_key(tagid, json_file_name)
-
-        save_to_s3_converted(
-            converted_bucket,
-            conv_s3_key,
-            json.dumps(converted_result, ensure_ascii=False, indent=2).encode('utf-8')
+        if incremental:
+            # 前回の配信より新しい観測値があった観測所だけを出力する。
+            # 今回更新されなかった要素は、最新1時間以内に配信済みの値を引き継ぐ
+            cutoff = (datetime.now(timezone.utc) - timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            published_stations = {}
+            for station_id, data in station_data.items():
+                if station_id in changed_stations:
+                    carry_forward_values(station_id, data, watermarks, observed_times.get(station_id, {}), cutoff)
+                    published_stations[station_id] = data
+            print(f"{len(published_stations)} stations have new observations")
+        else:
+            published_stations = station_data
+
+        conv_s3_key = None
+        if published_stations:
+            converted_result = create_converted_json(published_stations, observed_time)
+
+            current_time = datetime.now()
+            random_suffix = str(uuid.uuid4())
+            json_file_name = f"{current_time.strftime('%Y%m%d%H%M%S')}.{random_suffix}"
+            conv_s3_key = generate_json_s3_key(tagid, json_file_name)
+
+            save_to_s3_converted(
+                converted_bucket,
+                conv_s3_key,
+                json.dumps(converted_result, ensure_ascii=False, indent=2).encode('utf-8')
+            )
+        else:
+            print("No new observations since the last published run")
+
+        # 配信後にハイウォーターマークを進める（保存に失敗した場合は次回に同じ範囲を再取得する）
+        save_observed_watermarks(
+            raw_data_bucket,
+            tagid,
+            update_observed_watermarks(watermarks, observed_times, station_data, latest_observed)
         )
 
         result = {
@@ -698,10 +966,11 @@ def process_and_save_data():
             'body': json.dumps({
                 'message': 'Data successfully processed and saved',
                 'statistics': {
-                    'total_records': len(all_features),
-                    'total_stations': len(station_data),
+                    'total_records': total_records,
+                    'total_stations': len(published_stations),
                     'raw_data_location': f"s3://{raw_data_bucket}/{raw_s3_key}",
-                    'converted_data_location': f"s3://{converted_bucket}/{conv_s3_key}",
+                    'converted_data_location': f"s3://{converted_bucket}/{conv_s3_key}" if conv_s3_key else None,
+                    'publish_mode': 'incremental' if incremental else 'full',
                     'announced': created.strftime('%Y-%m-%dT%H:%M:%SZ'), 
                     'parameter_counts': parameter_counts
                 }
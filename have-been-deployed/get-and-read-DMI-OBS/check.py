@@ -0,0 +1,86 @@
+"""Check the incremental watermark handling of the DMI observation Lambda.
+
+Usage:
+    python check.py
+
+Two runs are replayed without the API: the features of each run are filtered
+by the `datetime` window that build_query_params would request, then folded
+with process_feature and update_observed_watermarks exactly like
+process_and_save_data does in `incremental` mode. Station A reports 10:50 in
+the first run while station B reports only 10:30; B's 10:40 value arrives
+late in the second run and must be fetched and published, while A's 10:50
+value, returned again by the overlapping window, must not be.
+"""
+import os
+import io
+import sys
+import contextlib
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app"))
+
+import main
+
+
+def observed_at(minutes_ago):
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    return (now - timedelta(minutes=minutes_ago)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def feature(station_id, parameter_id, value, observed):
+    return {"properties": {"stationId": station_id, "parameterId": parameter_id, "value": value, "observed": observed}}
+
+
+def replay(features, watermarks):
+    """Fold the features inside the query window and return the published station ids and their records."""
+    params = main.build_query_params(watermarks.get("latest"))
+    start = params["datetime"].split("/")[0] if "datetime" in params else observed_at(60)
+    station_marks = watermarks.get("stations", {})
+
+    station_data = {}
+    observed_times = {}
+    changed_stations = set()
+    parameter_counts = main.initialize_parameter_counts()
+    latest_observed = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for item in features:
+            observed = item["properties"]["observed"]
+            if observed < start:
+                continue
+            if not latest_observed or observed > latest_observed:
+                latest_observed = observed
+            if main.process_feature(item, station_data, parameter_counts, observed_times, station_marks):
+                changed_stations.add(item["properties"]["stationId"])
+    main.update_observed_watermarks(watermarks, observed_times, station_data, latest_observed)
+    return changed_stations, station_data
+
+
+def check_late_observation():
+    # A は 10:50、B は 10:30 まで配信済みのところに、B の 10:40 が遅れて届く
+    a_latest, b_late, b_first = observed_at(10), observed_at(20), observed_at(30)
+    watermarks = {}
+    replay([
+        feature("A", "temp_dry", 10.0, a_latest),
+        feature("B", "temp_dry", 5.0, b_first)
+    ], watermarks)
+
+    changed_stations, station_data = replay([
+        feature("A", "temp_dry", 10.0, a_latest),
+        feature("B", "temp_dry", 6.0, b_late)
+    ], watermarks)
+
+    failures = []
+    if changed_stations != {"B"}:
+        failures.append(f"published stations: expected ['B'], got {sorted(changed_stations)}")
+    if watermarks["stations"].get("B", {}).get("temp_dry") != b_late:
+        failures.append(f"B watermark: expected {b_late}, got {watermarks['stations'].get('B')}")
+    if "B" in station_data and station_data["B"]["AIRTMP"] != 60:
+        failures.append(f"B AIRTMP: expected 60, got {station_data['B']['AIRTMP']}")
+    for failure in failures:
+        print(failure)
+    print(f"late-arriving observation: {'ok' if not failures else 'FAILED'}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(check_late_observation())